@@ -5,37 +5,237 @@ HeMu State Manager - Tracks processed data and avoids recomputation
 
 import json
 import os
+import sqlite3
+import calendar
 import hashlib
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 import pandas as pd
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS processed_ranges (
+    date_key TEXT PRIMARY KEY,
+    start_ts INTEGER NOT NULL,
+    end_ts INTEGER NOT NULL,
+    variables TEXT NOT NULL,
+    processed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_processed_ranges_start ON processed_ranges (start_ts, end_ts);
+CREATE INDEX IF NOT EXISTS ix_processed_ranges_processed_at ON processed_ranges (processed_at);
+CREATE TABLE IF NOT EXISTS coverage (
+    variable TEXT NOT NULL,
+    start_slot INTEGER NOT NULL,
+    end_slot INTEGER NOT NULL,
+    PRIMARY KEY (variable, start_slot)
+);
+"""
+
+# Satellite repeat cycle (MSG full disk every 15 minutes); coverage is tracked per slot
+SLOT_SECONDS = int(os.getenv("HEMU_SLOT_MINUTES", "15")) * 60
+# Time-dependent inputs; the static topography variables are checked by is_static_data_valid
+TEMPORAL_VARS = ["HRV", "SZA", "SAA"]
+
+
+def to_epoch(value):
+    """Naive (UTC) datetime or pandas Timestamp -> epoch seconds"""
+    return calendar.timegm(pd.Timestamp(value).timetuple())
+
+
+def from_epoch(seconds):
+    return datetime.utcfromtimestamp(seconds)
+
+
+def date_key_for(start_date, end_date):
+    return f"{start_date.strftime('%Y%m%d%H%M')}-{end_date.strftime('%Y%m%d%H%M')}"
+
+
+def floor_slot(value):
+    return to_epoch(value) // SLOT_SECONDS
+
+
+def ceil_slot(value):
+    return -(-to_epoch(value) // SLOT_SECONDS)
+
+
+def slot_datetime(slot):
+    return from_epoch(slot * SLOT_SECONDS)
+
+
+def subtract_intervals(start, end, covered):
+    """Parts of [start, end) not in `covered` (sorted, disjoint [s, e) intervals)"""
+    gaps = []
+    cursor = start
+    for s, e in covered:
+        if s > cursor:
+            gaps.append((cursor, min(s, end)))
+        cursor = max(cursor, e)
+        if cursor >= end:
+            break
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def merge_intervals(intervals):
+    merged = []
+    for s, e in sorted(intervals):
+        if merged and s <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+
 class HeMuStateManager:
-    """Manages HeMu processing state to avoid unnecessary recomputations"""
+    """Manages HeMu processing state to avoid unnecessary recomputations
+    
+    State lives in an SQLite database (WAL mode, one transaction per update),
+    so concurrent runs cannot clobber each other and lookups stay indexed as
+    history grows. A legacy state_{domain}.json is imported on first use.
     
-    def __init__(self, domain="CH", state_file=None):
+    Besides the processed runs, each variable has its coverage stored as
+    disjoint, merged intervals of SLOT_SECONDS slots, so gaps can be found
+    whatever the alignment of earlier runs.
+    """
+    
+    def __init__(self, domain="CH", state_file=None, db_path=None):
         self.domain = domain
         self.hemu_root = Path(__file__).parent
-        self.state_file = state_file or self.hemu_root / f"state_{domain}.json"
-        self.state = self._load_state()
-        
-    def _load_state(self):
-        """Load processing state from file"""
-        if self.state_file.exists():
+        # Legacy JSON state, only read for the one-time migration
+        self.state_file = Path(state_file or self.hemu_root / f"state_{domain}.json")
+        self.db_path = Path(db_path or os.getenv("HEMU_STATE_DB", self.hemu_root / f"state_{domain}.db"))
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self._migrate_json_state()
+        self._backfill_coverage()
+    
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+    
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    
+    def _get_meta(self, conn, key):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+    
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                     "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value))
+    
+    def _touch(self, conn):
+        self._set_meta(conn, "last_update", datetime.now().isoformat())
+    
+    def _migrate_json_state(self):
+        """Import state_{domain}.json once, then keep it as .json.migrated"""
+        try:
             with open(self.state_file, 'r') as f:
-                return json.load(f)
-        return {
-            "domain_config": {},
-            "static_data": {},
-            "processed_dates": {},
-            "last_update": None
-        }
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        
+        with self._transaction() as conn:
+            domain_hash = state.get("domain_config", {}).get("hash")
+            if domain_hash and self._get_meta(conn, "domain_hash") is None:
+                self._set_meta(conn, "domain_hash", domain_hash)
+            for date_key, info in state.get("processed_dates", {}).items():
+                self._insert_range(conn, date_key, pd.to_datetime(info["start_date"]),
+                                   pd.to_datetime(info["end_date"]), info.get("variables", []),
+                                   info.get("processed_at") or datetime.now().isoformat())
+            self._touch(conn)
+        
+        try:
+            self.state_file.rename(self.state_file.with_name(self.state_file.name + ".migrated"))
+        except FileNotFoundError:
+            # Another process migrated it at the same time; the upserts above are idempotent
+            return
+        print(f"✅ Migrated {len(state.get('processed_dates', {}))} processed ranges from {self.state_file.name}")
+    
+    def _insert_range(self, conn, date_key, start_date, end_date, variables, processed_at):
+        start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+        conn.execute(
+            "INSERT INTO processed_ranges (date_key, start_ts, end_ts, variables, processed_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (date_key) DO UPDATE SET "
+            "variables = excluded.variables, processed_at = excluded.processed_at",
+            (date_key, start_ts, end_ts, json.dumps(variables), processed_at),
+        )
+        # Longest stored range, bounds the index scan of overlap queries
+        if end_ts - start_ts > int(self._get_meta(conn, "max_range_seconds") or 0):
+            self._set_meta(conn, "max_range_seconds", str(end_ts - start_ts))
+        for var in variables:
+            self._add_coverage(conn, var, start_date, end_date)
     
-    def _save_state(self):
-        """Save processing state to file"""
-        self.state["last_update"] = datetime.now().isoformat()
-        with open(self.state_file, 'w') as f:
-            json.dump(self.state, f, indent=2)
+    def _backfill_coverage(self):
+        """Build the coverage of runs recorded before it was tracked"""
+        with self._transaction() as conn:
+            if self._get_meta(conn, "coverage_slot_seconds") == str(SLOT_SECONDS):
+                return
+            conn.execute("DELETE FROM coverage")
+            for row in conn.execute("SELECT start_ts, end_ts, variables FROM processed_ranges").fetchall():
+                for var in json.loads(row["variables"]):
+                    self._add_coverage(conn, var, from_epoch(row["start_ts"]), from_epoch(row["end_ts"]))
+            self._set_meta(conn, "coverage_slot_seconds", str(SLOT_SECONDS))
+            # Superseded by get_high_water_mark(), which reads the coverage
+            conn.execute("DELETE FROM meta WHERE key = 'high_water_mark'")
+    
+    def _covered_slots(self, conn, variable, start_slot, end_slot):
+        """Coverage intervals of `variable` overlapping [start_slot, end_slot), by start"""
+        # Intervals are disjoint: only the last one starting before start_slot can reach into the range
+        previous = conn.execute(
+            "SELECT start_slot, end_slot FROM coverage WHERE variable = ? AND start_slot < ? "
+            "ORDER BY start_slot DESC LIMIT 1", (variable, start_slot)).fetchone()
+        rows = conn.execute(
+            "SELECT start_slot, end_slot FROM coverage WHERE variable = ? AND start_slot >= ? AND start_slot < ? "
+            "ORDER BY start_slot", (variable, start_slot, end_slot)).fetchall()
+        intervals = [(r["start_slot"], r["end_slot"]) for r in rows]
+        if previous is not None and previous["end_slot"] > start_slot:
+            intervals.insert(0, (previous["start_slot"], previous["end_slot"]))
+        return intervals
+    
+    def _add_coverage(self, conn, variable, start_date, end_date):
+        # Only slots entirely inside the range count as covered
+        start_slot, end_slot = ceil_slot(start_date), floor_slot(end_date)
+        if start_slot >= end_slot:
+            return
+        # Overlapping or adjacent intervals are merged into one
+        touching = self._covered_slots(conn, variable, start_slot - 1, end_slot + 1)
+        touching = [(s, e) for s, e in touching if e >= start_slot and s <= end_slot]
+        for s, _ in touching:
+            conn.execute("DELETE FROM coverage WHERE variable = ? AND start_slot = ?", (variable, s))
+        merged_start = min([start_slot] + [s for s, _ in touching])
+        merged_end = max([end_slot] + [e for _, e in touching])
+        conn.execute("INSERT INTO coverage (variable, start_slot, end_slot) VALUES (?, ?, ?)",
+                     (variable, merged_start, merged_end))
+    
+    def _remove_coverage(self, conn, variable, start_slot, end_slot):
+        for s, e in self._covered_slots(conn, variable, start_slot, end_slot):
+            conn.execute("DELETE FROM coverage WHERE variable = ? AND start_slot = ?", (variable, s))
+            for keep_start, keep_end in ((s, start_slot), (end_slot, e)):
+                if keep_start < keep_end:
+                    conn.execute("INSERT INTO coverage (variable, start_slot, end_slot) VALUES (?, ?, ?)",
+                                 (variable, keep_start, keep_end))
     
     def _compute_domain_hash(self, matcher_path, horayzon_path):
         """Compute hash of domain configuration"""
@@ -50,11 +250,13 @@ class HeMuStateManager:
     def is_static_data_valid(self, matcher_path, horayzon_path):
         """Check if static data (domain, topography) needs recomputation"""
         current_hash = self._compute_domain_hash(matcher_path, horayzon_path)
-        stored_hash = self.state["domain_config"].get("hash")
         
+        with self._transaction() as conn:
+            stored_hash = self._get_meta(conn, "domain_hash")
+            if stored_hash != current_hash:
+                self._set_meta(conn, "domain_hash", current_hash)
         if stored_hash != current_hash:
             print(f"🔄 Domain configuration changed, static data needs update")
-            self.state["domain_config"]["hash"] = current_hash
             return False
         
         # Check if static data files exist
@@ -70,75 +272,129 @@ class HeMuStateManager:
     
     def is_date_range_processed(self, start_date, end_date, required_vars=None):
         """Check if a date range has been fully processed"""
-        if required_vars is None:
-            required_vars = ["HRV", "SZA", "SAA"] + ["SRTMGL3_DEM", "slope", "aspectCos", "aspectSin"]
-        
-        date_key = f"{start_date.strftime('%Y%m%d%H%M')}-{end_date.strftime('%Y%m%d%H%M')}"
-        
-        if date_key not in self.state["processed_dates"]:
-            return False
-        
-        processed_info = self.state["processed_dates"][date_key]
-        
-        # Check if all required variables exist
-        for var in required_vars:
-            var_path = self.hemu_root / f"runs/{self.domain}/{date_key}/{var}/{var}.nc"
-            if not var_path.exists():
-                print(f"⚠️  Missing data for {date_key}: {var}")
-                return False
-        
-        print(f"✅ Date range {date_key} already processed")
-        return True
+        if not self.get_missing_date_ranges(start_date, end_date, required_vars=required_vars):
+            print(f"✅ Date range {date_key_for(start_date, end_date)} already processed")
+            return True
+        return False
     
     def mark_date_range_processed(self, start_date, end_date, variables):
         """Mark a date range as processed"""
-        date_key = f"{start_date.strftime('%Y%m%d%H%M')}-{end_date.strftime('%Y%m%d%H%M')}"
-        self.state["processed_dates"][date_key] = {
-            "start_date": start_date.isoformat(),
-            "end_date": end_date.isoformat(),
-            "variables": variables,
-            "processed_at": datetime.now().isoformat()
-        }
-        self._save_state()
+        with self._transaction() as conn:
+            self._insert_range(conn, date_key_for(start_date, end_date), start_date, end_date,
+                               variables, datetime.now().isoformat())
+            self._touch(conn)
     
-    def get_missing_date_ranges(self, start_date, end_date, chunk_days=7):
-        """Get list of date ranges that need processing"""
-        missing_ranges = []
-        current_date = start_date
+    def get_high_water_mark(self, required_vars=None):
+        """Where incremental runs continue: the earliest coverage end of `required_vars`, or None"""
+        required_vars = required_vars or TEMPORAL_VARS
+        with self._connect() as conn:
+            return self._high_water_mark(conn, required_vars)
+    
+    def _high_water_mark(self, conn, required_vars):
+        ends = []
+        for var in required_vars:
+            # Intervals are disjoint: the last one by start also ends last
+            row = conn.execute("SELECT end_slot FROM coverage WHERE variable = ? "
+                               "ORDER BY start_slot DESC LIMIT 1", (var,)).fetchone()
+            if row is None:
+                return None
+            ends.append(row["end_slot"])
+        return slot_datetime(min(ends))
+    
+    def get_processed_ranges(self, start_date, end_date):
+        """Processed ranges overlapping [start_date, end_date), ordered by start"""
+        start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+        with self._connect() as conn:
+            # An overlapping range starts at most max_range_seconds before start_date,
+            # so the index scan covers only the neighbourhood of the query
+            max_range = int(self._get_meta(conn, "max_range_seconds") or 0)
+            rows = conn.execute(
+                "SELECT date_key, start_ts, end_ts, variables, processed_at FROM processed_ranges "
+                "WHERE start_ts >= ? AND start_ts < ? AND end_ts > ? ORDER BY start_ts",
+                (start_ts - max_range, end_ts, start_ts),
+            ).fetchall()
+        return [{
+            "date_key": row["date_key"],
+            "start_date": from_epoch(row["start_ts"]),
+            "end_date": from_epoch(row["end_ts"]),
+            "variables": json.loads(row["variables"]),
+            "processed_at": row["processed_at"],
+        } for row in rows]
+    
+    def get_missing_date_ranges(self, start_date, end_date, chunk_days=7, required_vars=None):
+        """Get the minimal list of date ranges that need processing
+        
+        A slot is missing when any of `required_vars` does not cover it. Gaps
+        are aligned to the slot grid and split into chunks of at most
+        `chunk_days`.
+        """
+        required_vars = required_vars or TEMPORAL_VARS
+        start_slot, end_slot = floor_slot(start_date), ceil_slot(end_date)
         
-        while current_date < end_date:
-            chunk_end = min(current_date + pd.Timedelta(days=chunk_days), end_date)
-            
-            if not self.is_date_range_processed(current_date, chunk_end):
-                missing_ranges.append((current_date, chunk_end))
-            
-            current_date = chunk_end
+        gaps = []
+        with self._connect() as conn:
+            for var in required_vars:
+                gaps += subtract_intervals(start_slot, end_slot, self._covered_slots(conn, var, start_slot, end_slot))
+        
+        chunk_slots = max(int(chunk_days * 86400 // SLOT_SECONDS), 1)
+        missing_ranges = []
+        for gap_start, gap_end in merge_intervals(gaps):
+            for chunk_start in range(gap_start, gap_end, chunk_slots):
+                chunk_end = min(chunk_start + chunk_slots, gap_end)
+                missing_ranges.append((slot_datetime(chunk_start), slot_datetime(chunk_end)))
         
         return missing_ranges
     
     def cleanup_old_data(self, keep_days=30):
         """Remove old processed data to save space"""
-        cutoff_date = datetime.now() - pd.Timedelta(days=keep_days)
+        cutoff_date = (datetime.now() - pd.Timedelta(days=keep_days)).isoformat()
         
-        to_remove = []
-        for date_key, info in self.state["processed_dates"].items():
-            processed_at = pd.to_datetime(info["processed_at"])
-            if processed_at < cutoff_date:
-                # Remove data directory
-                data_dir = self.hemu_root / f"runs/{self.domain}/{date_key}"
-                if data_dir.exists():
-                    import shutil
-                    shutil.rmtree(data_dir)
-                    print(f"🗑️  Removed old data: {date_key}")
-                to_remove.append(date_key)
+        with self._connect() as conn:
+            to_remove = [dict(row) for row in conn.execute(
+                "SELECT date_key, start_ts, end_ts, variables FROM processed_ranges WHERE processed_at < ?",
+                (cutoff_date,))]
         
-        for key in to_remove:
-            del self.state["processed_dates"][key]
+        for info in to_remove:
+            # Remove data directory
+            data_dir = self.hemu_root / f"runs/{self.domain}/{info['date_key']}"
+            if data_dir.exists():
+                import shutil
+                shutil.rmtree(data_dir)
+                print(f"🗑️  Removed old data: {info['date_key']}")
         
-        self._save_state()
+        with self._transaction() as conn:
+            for info in to_remove:
+                conn.execute("DELETE FROM processed_ranges WHERE date_key = ?", (info["date_key"],))
+                start_slot, end_slot = floor_slot(from_epoch(info["start_ts"])), ceil_slot(from_epoch(info["end_ts"]))
+                for var in json.loads(info["variables"]):
+                    self._remove_coverage(conn, var, start_slot, end_slot)
+            # Slots of the removed runs that other runs still cover
+            for info in to_remove:
+                for row in conn.execute(
+                        "SELECT start_ts, end_ts, variables FROM processed_ranges WHERE start_ts < ? AND end_ts > ?",
+                        (info["end_ts"], info["start_ts"])).fetchall():
+                    for var in json.loads(row["variables"]):
+                        self._add_coverage(conn, var, from_epoch(row["start_ts"]), from_epoch(row["end_ts"]))
+            self._touch(conn)
+    
+    def summary(self):
+        """Number of processed ranges, covered period, coverage intervals and last update"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT COUNT(*), MIN(start_ts), MAX(end_ts) FROM processed_ranges").fetchone()
+            intervals = dict(conn.execute("SELECT variable, COUNT(*) FROM coverage GROUP BY variable").fetchall())
+            last_update = self._get_meta(conn, "last_update")
+            high_water_mark = self._high_water_mark(conn, TEMPORAL_VARS)
+        return {
+            "processed_ranges": row[0],
+            "coverage_intervals": intervals,
+            "first_start": from_epoch(row[1]).isoformat() if row[1] is not None else None,
+            "last_end": from_epoch(row[2]).isoformat() if row[2] is not None else None,
+            "high_water_mark": high_water_mark.isoformat() if high_water_mark else None,
+            "last_update": last_update,
+        }
 
 if __name__ == "__main__":
     # Test the state manager
     state_mgr = HeMuStateManager("CH")
-    print(f"State file: {state_mgr.state_file}")
-    print(f"Current state: {state_mgr.state}")
+    print(f"State database: {state_mgr.db_path}")
+    print(f"Current state: {state_mgr.summary()}")
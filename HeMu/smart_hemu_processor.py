@@ -14,7 +14,7 @@ import pandas as pd
 # Add HeMu scripts to path
 sys.path.append(str(Path(__file__).parent / "scripts"))
 
-from hemu_state_manager import HeMuStateManager
+from hemu_state_manager import HeMuStateManager, SLOT_SECONDS
 
 # Configure logging
 logging.basicConfig(
@@ -23,6 +23,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Process only the slots after the covered ones (the high-water mark) instead of every gap in
+# the lookback window. Off by default: a run starting at the mark has no temporal context
+HEMU_INCREMENTAL = os.getenv("HEMU_INCREMENTAL", "false").lower() == "true"
+# Temporal context window of the model. Outside incremental mode every gap is run together with
+# the slots of this window before it, and only the gap's own slots are published
+HEMU_CONTEXT_MINUTES = int(os.getenv("HEMU_CONTEXT_MINUTES", "60"))
+
 class SmartHeMuProcessor:
     """Automated HeMu processing with intelligent caching"""
     
@@ -88,9 +95,16 @@ class SmartHeMuProcessor:
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(hours=self.lookback_hours)
         
-        # Round to nearest hour
-        start_date = start_date.replace(minute=0, second=0, microsecond=0)
-        end_date = end_date.replace(minute=0, second=0, microsecond=0)
+        # Round down to the satellite slot grid
+        start_date = pd.Timestamp(start_date).floor(f"{SLOT_SECONDS}s").to_pydatetime()
+        end_date = pd.Timestamp(end_date).floor(f"{SLOT_SECONDS}s").to_pydatetime()
+        
+        # Continue from the last processed slot instead of redoing the lookback window
+        if HEMU_INCREMENTAL:
+            high_water_mark = self.state_manager.get_high_water_mark()
+            if high_water_mark is not None and high_water_mark > start_date:
+                logger.info(f"⏩ Incremental run from high-water mark {high_water_mark}")
+                start_date = min(high_water_mark, end_date)
         
         return start_date, end_date
     
@@ -160,54 +174,78 @@ class SmartHeMuProcessor:
             logger.error(f"❌ Satellite data processing failed: {e}")
             return False
     
-    def convert_to_app_format(self, start_date, end_date):
-        """Convert HeMu output to app-compatible COG format"""
-        logger.info("🔄 Converting HeMu output to COG format...")
+    def published_predictions(self, prediction_files, publish_from, publish_dir):
+        """Restrict prediction files to the slots from `publish_from` on
+        
+        Context slots were only recomputed to give the model its temporal context; their
+        published frames stay as they are. Files that mix both are written trimmed to `publish_dir`.
+        """
+        import numpy as np
+        import xarray as xr
+        
+        published = []
+        for path in prediction_files:
+            with xr.open_dataset(path) as ds:
+                if "time" not in ds.coords:
+                    published.append(path)
+                    continue
+                keep = ds["time"].values >= np.datetime64(publish_from)
+                if keep.all():
+                    published.append(path)
+                    continue
+                if not keep.any():
+                    continue
+                subset = ds.isel(time=np.nonzero(keep)[0]).load()
+            publish_dir.mkdir(parents=True, exist_ok=True)
+            trimmed_path = publish_dir / Path(path).name
+            subset.to_netcdf(trimmed_path)
+            published.append(str(trimmed_path))
+        return published
+    
+    def convert_to_app_format(self, start_date, end_date, publish_from=None):
+        """Queue HeMu output for COG conversion by the app's ingest workers
+        
+        With `publish_from`, slots before it (the run's context window) are left out.
+        """
+        logger.info("🔄 Queueing HeMu output for COG conversion...")
         
         try:
-            # Import conversion utilities from main app
+            # Job queue shared with the main app (app/jobqueue.py, stdlib only)
             sys.path.append(str(Path(__file__).parent.parent / "app"))
-            from convert import convert_netcdf_to_cog
+            from jobqueue import JobQueue
             
             # Find HeMu output files
             date_key = f"{start_date.strftime('%Y%m%d%H%M')}-{end_date.strftime('%Y%m%d%H%M')}"
             hemu_output_dir = self.hemu_root / f"runs/{self.domain}/{date_key}"
             
             # Look for solar irradiance predictions (adjust variable name as needed)
-            prediction_files = list(hemu_output_dir.glob("**/predictions_*.nc"))
+            publish_dir = hemu_output_dir / "published"
+            prediction_files = sorted(str(p) for p in hemu_output_dir.glob("**/predictions_*.nc")
+                                      if publish_dir not in p.parents)
             
             if not prediction_files:
                 logger.warning("No HeMu prediction files found")
                 return False
             
-            # Convert predictions to COG format
-            app_cogs_dir = Path(__file__).parent.parent / "data/cogs"
-            app_cogs_dir.mkdir(exist_ok=True)
+            if publish_from is not None and publish_from > start_date:
+                prediction_files = self.published_predictions(prediction_files, publish_from, publish_dir)
+                if not prediction_files:
+                    logger.warning(f"No HeMu predictions from {publish_from} on")
+                    return False
             
-            converted_count = 0
-            for pred_file in prediction_files:
-                try:
-                    # Extract timestamp from filename
-                    # (This will need adjustment based on actual HeMu output format)
-                    timestamp_str = pred_file.stem.split('_')[-1]  # Adjust as needed
-                    
-                    # Convert to COG
-                    cog_path, timestamp, vmin, vmax = convert_netcdf_to_cog(
-                        str(pred_file), 
-                        variable_name="solar_irradiance"  # Adjust variable name
-                    )
-                    
-                    logger.info(f"✅ Converted: {pred_file.name} -> {cog_path}")
-                    converted_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"❌ Failed to convert {pred_file}: {e}")
+            # Converted (and recorded in the DB) by `ingest.py --worker` with VARIABLE=solar_irradiance;
+            # files that are already queued or done are not queued again
+            queued = JobQueue().enqueue(
+                "solar_irradiance",  # Adjust variable name
+                prediction_files,
+                payload={"domain": self.domain, "run": date_key},
+            )
             
-            logger.info(f"✅ Converted {converted_count} files to COG format")
-            return converted_count > 0
+            logger.info(f"✅ Queued {queued} of {len(prediction_files)} prediction file(s) for conversion")
+            return True
             
         except Exception as e:
-            logger.error(f"❌ COG conversion failed: {e}")
+            logger.error(f"❌ Queueing COG conversion failed: {e}")
             return False
     
     def cleanup_old_data(self):
@@ -233,18 +271,26 @@ class SmartHeMuProcessor:
         start_date, end_date = self.get_processing_dates()
         logger.info(f"📅 Processing period: {start_date} to {end_date}")
         
-        # Check if already processed
-        if self.state_manager.is_date_range_processed(start_date, end_date):
+        # Only the slots that no earlier run covered, whatever its alignment
+        missing_ranges = self.state_manager.get_missing_date_ranges(start_date, end_date)
+        if not missing_ranges:
             logger.info("✅ Data already processed, skipping")
             return True
         
-        # Process satellite data
-        if not self.process_satellite_data(start_date, end_date):
-            return False
-        
-        # Convert to app format
-        if not self.convert_to_app_format(start_date, end_date):
-            logger.warning("⚠️  COG conversion failed, but processing succeeded")
+        # Gaps are often a single slot: run each with the slots before it so the model
+        # has its temporal context, instead of a cold single-slot inference
+        context = timedelta(minutes=0 if HEMU_INCREMENTAL else HEMU_CONTEXT_MINUTES)
+        for gap_start, gap_end in missing_ranges:
+            run_start = gap_start - context
+            logger.info(f"🧩 Processing gap: {gap_start} to {gap_end} (run from {run_start})")
+            
+            # Process satellite data
+            if not self.process_satellite_data(run_start, gap_end):
+                return False
+            
+            # Convert to app format, publishing only the gap's slots
+            if not self.convert_to_app_format(run_start, gap_end, publish_from=gap_start):
+                logger.warning("⚠️  Queueing COG conversion failed, but processing succeeded")
         
         # Cleanup old data
         self.cleanup_old_data()
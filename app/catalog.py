@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from db import MapRecord, get_catalog_version
+
+DATETIME_FORMAT = os.getenv('DATETIME_FORMAT', '%Y%m%dT%H%M%S')
+# Seconds during which a cached catalog version is trusted without asking the DB
+TIMESTAMPS_VERSION_TTL = float(os.getenv("TIMESTAMPS_VERSION_TTL", "2"))
+
+
+def parse_since(value: Optional[str]) -> Optional[datetime]:
+    """Accept the DATETIME_FORMAT strings /timestamps returns as well as ISO datetimes."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, DATETIME_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+class TimestampCatalog:
+    """Serialized /timestamps responses, rebuilt only when the catalog version changes.
+
+    Ingest bumps the version in the same transaction as its inserts, so a
+    request costs one primary-key lookup (at most every
+    TIMESTAMPS_VERSION_TTL seconds) plus a bisect into the cached list.
+    """
+
+    def __init__(self, version_ttl: float = TIMESTAMPS_VERSION_TTL):
+        self.version_ttl = version_ttl
+        self.version = None
+        self.checked_at = 0.0
+        self.entries = {}
+
+    async def current_version(self, db) -> int:
+        now = time.monotonic()
+        if self.version is None or now - self.checked_at >= self.version_ttl:
+            version = await get_catalog_version(db)
+            if version != self.version:
+                self.entries = {}
+                self.version = version
+            self.checked_at = now
+        return self.version
+
+    async def _load(self, db, variable: Optional[str]) -> Dict[str, Any]:
+        query = select(MapRecord.acquisition_datetime, MapRecord.vmin, MapRecord.vmax, MapRecord.filepath)
+        if variable:
+            query = query.where(MapRecord.variable == variable)
+        rows = (await db.execute(query.order_by(MapRecord.acquisition_datetime))).all()
+        items = [{
+            'datetime': r[0].strftime(DATETIME_FORMAT),
+            'vmin': r[1],
+            'vmax': r[2],
+            'filepath': r[3]
+        } for r in rows]
+        return {
+            "datetimes": [r[0] for r in rows],
+            "items": items,
+            "body": json.dumps(items).encode(),
+        }
+
+    async def page(self, db, variable: Optional[str] = None, since: Optional[datetime] = None,
+                   limit: Optional[int] = None) -> Dict[str, Any]:
+        """Return the JSON body, ETag and, when truncated, the `since` of the next page."""
+        version = await self.current_version(db)
+        entry = self.entries.get(variable)
+        if entry is None:
+            entry = await self._load(db, variable)
+            # Another request may have seen a newer version while this one was loading
+            if self.version == version:
+                self.entries[variable] = entry
+
+        tag = hashlib.sha1(f"{version}|{variable}|{since}|{limit}".encode()).hexdigest()[:16]
+        start = bisect.bisect_right(entry["datetimes"], since) if since else 0
+        if start == 0 and limit is None:
+            return {"body": entry["body"], "etag": f'"{tag}"', "next": None, "count": len(entry["items"])}
+
+        end = len(entry["items"]) if limit is None else min(start + limit, len(entry["items"]))
+        items: List[Dict[str, Any]] = entry["items"][start:end]
+        next_since = items[-1]['datetime'] if end < len(entry["items"]) and items else None
+        return {"body": json.dumps(items).encode(), "etag": f'"{tag}"', "next": next_since, "count": len(items)}
@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import glob
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import rasterio
+
+from download import COG_DIR, TITILER_COG_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# JSON-lines sidecar listing every COG with its value range, appended by ingest.
+# Lets /timestamps answer from the filesystem when the DB is down.
+COG_INDEX_PATH = os.getenv("COG_INDEX_PATH", "data/cogs_index.jsonl")
+
+# {variable}_{datetime}_{content_hash}.tif as written by convert_data_array (older files have no hash)
+COG_NAME_PATTERN = re.compile(r'^(?P<variable>.+)_(?P<datetime>\d{8}T\d{6})(?:_(?P<hash>[0-9a-f]+))?\.tif$')
+
+
+def append_entries(entries: Iterable[Dict[str, Any]], path: Optional[str] = None) -> int:
+    """Append index entries ({variable, datetime, vmin, vmax, filepath}) in one write."""
+    lines = [json.dumps(entry) + "\n" for entry in entries]
+    if not lines:
+        return 0
+    path = path or COG_INDEX_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        f.write("".join(lines))
+    return len(lines)
+
+
+def entry_from_cog(path: str, cog_dir: str) -> Optional[Dict[str, Any]]:
+    """Index entry of an existing COG, from its name and the statistics tags add_metadata wrote."""
+    match = COG_NAME_PATTERN.match(os.path.basename(path))
+    if not match:
+        return None
+    with rasterio.open(path) as src:
+        tags = src.tags()
+    return {
+        "variable": match.group("variable"),
+        "datetime": match.group("datetime"),
+        "vmin": float(tags["min"]) if "min" in tags else None,
+        "vmax": float(tags["max"]) if "max" in tags else None,
+        "filepath": TITILER_COG_PREFIX + os.path.relpath(path, cog_dir),
+    }
+
+
+def rebuild_index(cog_dir: Optional[str] = None, path: Optional[str] = None) -> int:
+    """Write the index from the COGs on disk; used once when no index exists yet."""
+    path = path or COG_INDEX_PATH
+    cog_dir = cog_dir or COG_DIR
+    entries = []
+    for cog_path in sorted(glob.glob(os.path.join(cog_dir, "*.tif"))):
+        try:
+            entry = entry_from_cog(cog_path, cog_dir)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not index {cog_path}: {e}")
+            continue
+        if entry is not None:
+            entries.append(entry)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(tmp_path, "w") as f:
+        f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+    os.replace(tmp_path, path)
+    logger.info(f"✅ Rebuilt COG index with {len(entries)} entries")
+    return len(entries)
+
+
+def ensure_index(cog_dir: Optional[str] = None, path: Optional[str] = None) -> None:
+    if not os.path.exists(path or COG_INDEX_PATH):
+        rebuild_index(cog_dir, path)
+
+
+class CogIndex:
+    """In-memory view of the index file, reloaded only when the file changes.
+
+    The file is append-only between rebuilds, so when it has grown in place
+    only the new lines are read.
+    """
+
+    def __init__(self, path: Optional[str] = None, cog_dir: Optional[str] = None):
+        self.path = path or COG_INDEX_PATH
+        self.cog_dir = cog_dir
+        self.inode = None
+        self.mtime_ns = None
+        self.offset = 0
+        self.entries = {}
+        self.sorted_cache = {}
+        self.lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        ensure_index(self.cog_dir, self.path)
+        st = os.stat(self.path)
+        if st.st_ino == self.inode and st.st_mtime_ns == self.mtime_ns and st.st_size == self.offset:
+            return
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # Replaced by a rebuild: start over
+            self.entries = {}
+            self.offset = 0
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave a partially written last line for the next refresh
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            self.entries[(entry["variable"], entry["datetime"])] = entry
+        self.offset += complete
+        self.inode = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        self.sorted_cache = {}
+
+    def timestamps(self, variable: Optional[str] = None) -> List[Dict[str, Any]]:
+        """/timestamps entries sorted by datetime, optionally for one variable."""
+        with self.lock:
+            self._refresh()
+            if variable not in self.sorted_cache:
+                entries = [e for (v, _), e in self.entries.items() if variable is None or v == variable]
+                self.sorted_cache[variable] = [
+                    {'datetime': e["datetime"], 'vmin': e["vmin"], 'vmax': e["vmax"], 'filepath': e["filepath"]}
+                    for e in sorted(entries, key=lambda e: e["datetime"])
+                ]
+            return self.sorted_cache[variable]
@@ -1,14 +1,26 @@
 import os
 import json
+import math
+import zlib
+import struct
+import hashlib
 import logging
 from pathlib import Path
 from datetime import datetime
-from typing import Tuple, Optional, Union, Dict, Any
+from typing import Tuple, Optional, Union, Dict, Any, Iterator, List
 import numpy as np
 import xarray as xr
 import rasterio
+from rasterio.warp import calculate_default_transform
 # import matplotlib.pyplot as plt
 from pandas import to_datetime
+from metrics import metrics
+
+try:
+    import dask  # noqa: F401
+    HAS_DASK = True
+except ImportError:
+    HAS_DASK = False
 
 # Constants
 DATETIME_FORMAT = os.environ["DATETIME_FORMAT"]
@@ -17,13 +29,55 @@ DEFAULT_COG_OPTIONS = {
     "driver": "COG",
     "compress": "DEFLATE",
     "predictor": 2,
-    # "tiled": True,
-    # "blockxsize": 256, 
-    # "blockysize": 256,
+    # The COG driver always tiles; overviews are built down to one block
+    "blocksize": 512,
+    "overview_resampling": "average",
+    "overviews": "AUTO",
+    "nodata": NODATA_VALUE
+}
+# Pre-warped to EPSG:3857 on the WebMercatorQuad grid, so TiTiler can serve
+# /cog/tiles/WebMercatorQuad requests without reprojecting on the fly
+WEBMERCATOR_COG_OPTIONS = {
+    "driver": "COG",
+    "tiling_scheme": "GoogleMapsCompatible",
+    "blocksize": 256,
+    "compress": "ZSTD",
+    "predictor": "FLOATING_POINT",
+    "resampling": "bilinear",
     "overview_resampling": "average",
-    # "overview_levels": [2, 4, 8, 16],
+    "overviews": "AUTO",
     "nodata": NODATA_VALUE
 }
+COG_PROFILES = {
+    "default": DEFAULT_COG_OPTIONS,
+    "webmercator": WEBMERCATOR_COG_OPTIONS,
+}
+LERC_COMPRESSIONS = ("LERC", "LERC_DEFLATE", "LERC_ZSTD")
+# WebMercatorQuad: width of the EPSG:3857 world and deepest zoom level GDAL's COG driver uses
+WEBMERCATOR_WORLD_WIDTH = 2 * math.pi * 6378137
+WEBMERCATOR_MAX_ZOOM = 30
+# Output profile selection, see resolve_cog_options()
+COG_PROFILE = os.getenv("COG_PROFILE", "default")
+COG_COMPRESS = os.getenv("COG_COMPRESS")
+COG_BLOCKSIZE = os.getenv("COG_BLOCKSIZE")
+COG_MAX_Z_ERROR = float(os.getenv("COG_MAX_Z_ERROR", "0.1"))
+# Optional integer output with scale/offset, see resolve_quantization()
+COG_QUANTIZE = os.getenv("COG_QUANTIZE", "").lower()
+COG_SCALE_FACTOR = float(os.getenv("COG_SCALE_FACTOR", "0.1"))
+COG_ADD_OFFSET = float(os.getenv("COG_ADD_OFFSET", "0"))
+# Reserved integer codes for NoData, kept out of the valid value range
+QUANTIZED_NODATA = {"uint16": 65535, "int16": -32768}
+# Statistics kernel settings: rows per block (0 = whole frame) and histogram layout
+STATS_CHUNK_ROWS = int(os.getenv("STATS_CHUNK_ROWS", "256"))
+HISTOGRAM_BINS = int(os.getenv("HISTOGRAM_BINS", "64"))
+HISTOGRAM_RANGE = tuple(float(v) for v in os.getenv("HISTOGRAM_RANGE", "0,1500").split(","))
+
+# Bytes of the content hash in COG file names (hex length is twice this)
+CONTENT_HASH_BYTES = 6
+
+# Post-write COG compliance check: "off", "sampled" (COG_VALIDATION_SAMPLE_PERCENT of files) or "full"
+COG_VALIDATION = os.getenv("COG_VALIDATION", "sampled")
+COG_VALIDATION_SAMPLE_PERCENT = float(os.getenv("COG_VALIDATION_SAMPLE_PERCENT", "5"))
 
 # Configure logging
 logging.basicConfig(
@@ -33,14 +87,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def open_netcdf_dataset(file_path: Union[str, Path]) -> xr.Dataset:
+def open_netcdf_dataset(
+    file_path: Union[str, Path],
+    chunks: Optional[Dict[str, int]] = None) -> xr.Dataset:
 
     file_path = Path(file_path)
     if not file_path.exists():
         raise FileNotFoundError(f"NetCDF file not found: {file_path}")
     
     try:
-        return xr.open_dataset(file_path)
+        with metrics.span("open"):
+            dataset = xr.open_dataset(file_path, chunks=chunks)
+        metrics.add("netcdf_bytes_read", file_path.stat().st_size)
+        return dataset
     except Exception as e:
         raise ValueError(f"Failed to open NetCDF file: {e}")
 
@@ -64,16 +123,102 @@ def extract_variable_data(
     return data_array, timestamp
 
 
-def prepare_data_array(data_array: xr.DataArray) -> xr.DataArray:
+def iter_time_slices(
+    dataset: xr.Dataset,
+    variable_name: str,
+    time_range: Optional[Tuple[Optional[int], Optional[int]]] = None) -> Iterator[Tuple[xr.DataArray, str]]:
 
-    # Convert to float32 for better compatibility
-    if data_array.dtype != np.float32:
-        data_array = data_array.astype(np.float32)
+    if variable_name not in dataset:
+        raise ValueError(f"Variable '{variable_name}' not found in dataset")
     
-    # Replace NaN values with NoData
-    if np.isnan(data_array.values).any():
-        logger.info("Replacing NaN values with NoData value")
-        data_array = data_array.fillna(NODATA_VALUE)
+    if "time" not in dataset.dims:
+        yield extract_variable_data(dataset, variable_name)
+        return
+    
+    # Parse the time axis once instead of per frame
+    times = to_datetime(dataset.time.values)
+    start, stop = time_range or (None, None)
+    for time_index in range(*slice(start, stop).indices(len(times))):
+        data_array = dataset[variable_name].isel(time=time_index)
+        yield data_array, times[time_index].strftime(DATETIME_FORMAT)
+
+
+def compute_statistics(
+    values: np.ndarray,
+    nodata: float = NODATA_VALUE,
+    fill_nan: bool = True,
+    chunk_rows: int = STATS_CHUNK_ROWS) -> Dict[str, Any]:
+    """Masked min/max/mean/std/count and histogram of a 2D frame in a single pass.
+
+    Pixels that are NaN or equal to `nodata` are excluded. With `fill_nan`,
+    NaNs are replaced by `nodata` in place while the mask is at hand, so no
+    separate fillna pass is needed. The frame is processed in blocks of
+    `chunk_rows` rows that stay cache-resident; block moments are merged
+    with Chan's parallel variance update.
+    """
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    data_min = np.inf
+    data_max = -np.inf
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    
+    rows = values.shape[0]
+    step = chunk_rows if chunk_rows > 0 else max(rows, 1)
+    for start in range(0, rows, step):
+        block = values[start:start + step]
+        nan_mask = np.isnan(block)
+        if fill_nan:
+            block[nan_mask] = nodata
+        valid = block[~(nan_mask | (block == nodata))]
+        if valid.size == 0:
+            continue
+        
+        block_count = valid.size
+        block_mean = float(valid.mean(dtype=np.float64))
+        block_m2 = float(np.square(valid - block_mean, dtype=np.float64).sum())
+        delta = block_mean - mean
+        total = count + block_count
+        mean += delta * block_count / total
+        m2 += block_m2 + delta * delta * count * block_count / total
+        count = total
+        
+        data_min = min(data_min, float(valid.min()))
+        data_max = max(data_max, float(valid.max()))
+        histogram += np.histogram(valid, bins=HISTOGRAM_BINS, range=HISTOGRAM_RANGE)[0]
+    
+    # Same [counts, bin_edges] layout as rio-tiler statistics
+    histogram = [histogram.tolist(), np.linspace(*HISTOGRAM_RANGE, HISTOGRAM_BINS + 1).tolist()]
+    if count == 0:
+        return {
+            "min": None, "max": None, "mean": None, "std": None,
+            "count": 0, "nodata_count": int(values.size),
+            "histogram": histogram,
+        }
+    
+    return {
+        "min": data_min,
+        "max": data_max,
+        "mean": mean,
+        "std": float(np.sqrt(m2 / count)),
+        "count": count,
+        "nodata_count": int(values.size - count),
+        "histogram": histogram,
+    }
+
+
+def prepare_data_array(data_array: xr.DataArray) -> Tuple[xr.DataArray, Dict[str, Any]]:
+
+    # Convert to float32 for better compatibility; load (decode) the frame once
+    with metrics.span("decode"):
+        values = np.asarray(data_array.values, dtype=np.float32)
+        if not values.flags.writeable:
+            values = values.copy()
+    
+    # Statistics and NaN -> NoData replacement in one pass over the frame
+    with metrics.span("stats"):
+        stats = compute_statistics(values)
+    data_array = data_array.copy(data=values)
     
     # Handle _FillValue properly to avoid encoding issues
     data_array.encoding.update({"_FillValue": NODATA_VALUE})
@@ -81,50 +226,91 @@ def prepare_data_array(data_array: xr.DataArray) -> xr.DataArray:
         del data_array.attrs['_FillValue']
     
     # Log diagnostics
-    logger.info(f"Data range: {data_array.min().values} to {data_array.max().values}")
+    logger.info(f"Data range: {stats['min']} to {stats['max']}")
     logger.info(f"Data shape: {data_array.shape}")
-    logger.info(f"Data contains NaNs: {np.isnan(data_array.values).any()}")
+    logger.info(f"NoData pixels: {stats['nodata_count']} of {values.size}")
     
     # Ensure georeferencing
-    try:
-        # Check if spatial dimensions exist
-        if 'x' in data_array.dims and 'y' in data_array.dims:
-            logger.info("Using x/y dimensions for spatial reference")
-            data_array.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
-        elif 'lon' in data_array.dims and 'lat' in data_array.dims:
-            logger.info("Using lon/lat dimensions for spatial reference")
-            data_array.rio.set_spatial_dims(x_dim="lon", y_dim="lat", inplace=True)
-        else:
-            logger.error(f"Available dimensions: {list(data_array.dims)}")
-            raise ValueError("No recognized spatial dimensions found")
+    with metrics.span("georeference"):
+        try:
+            # Check if spatial dimensions exist
+            if 'x' in data_array.dims and 'y' in data_array.dims:
+                logger.info("Using x/y dimensions for spatial reference")
+                data_array.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
+            elif 'lon' in data_array.dims and 'lat' in data_array.dims:
+                logger.info("Using lon/lat dimensions for spatial reference")
+                data_array.rio.set_spatial_dims(x_dim="lon", y_dim="lat", inplace=True)
+            else:
+                logger.error(f"Available dimensions: {list(data_array.dims)}")
+                raise ValueError("No recognized spatial dimensions found")
         
-        # Set CRS
-        data_array.rio.write_crs("EPSG:4326", inplace=True)
+            # Set CRS
+            data_array.rio.write_crs("EPSG:4326", inplace=True)
             
-        # Check coordinates
-        logger.info(f"Y-coordinates order: {data_array.y.values[0]} to {data_array.y.values[-1]}")
-        logger.info(f"X-coordinates order: {data_array.x.values[0]} to {data_array.x.values[-1]}")
+            # Check coordinates
+            logger.info(f"Y-coordinates order: {data_array.y.values[0]} to {data_array.y.values[-1]}")
+            logger.info(f"X-coordinates order: {data_array.x.values[0]} to {data_array.x.values[-1]}")
         
-        # Fix Y coordinates if needed (north should be at top)
-        if data_array.y[0] < data_array.y[-1]:
-            logger.info("Y-coordinates are in ascending order (south to north), inverting...")
-            new_y = np.sort(data_array.y.values)[::-1]
-            data_array = data_array.reindex(y=new_y)
-            logger.info(f"New Y-coordinates order: {data_array.y.values[0]} to {data_array.y.values[-1]}")
+            # Fix Y coordinates if needed (north should be at top)
+            if data_array.y[0] < data_array.y[-1]:
+                logger.info("Y-coordinates are in ascending order (south to north), inverting...")
+                data_array = data_array.isel(y=slice(None, None, -1))
+                logger.info(f"New Y-coordinates order: {data_array.y.values[0]} to {data_array.y.values[-1]}")
     
-    except Exception as e:
-        raise ValueError(f"Error setting georeferencing: {str(e)}")
+        except Exception as e:
+            raise ValueError(f"Error setting georeferencing: {str(e)}")
     
-    return data_array
+    return data_array, stats
+
+
+def webmercator_zoom_resolution(source_resolution: float, tile_size: int = 256) -> float:
+    """Pixel size (m) of the WebMercatorQuad zoom level GDAL's COG driver warps to.
 
+    Mirrors its default ZOOM_LEVEL_STRATEGY=AUTO: the level whose
+    resolution is closest to the source resolution, compared as ratios.
+    """
+    def level_resolution(zoom):
+        return WEBMERCATOR_WORLD_WIDTH / tile_size / 2 ** zoom
 
-def add_metadata(data_array: xr.DataArray, units: str = "W/m^2", data_type: str = "irradiance") -> xr.DataArray:
+    zoom = 0
+    while zoom < WEBMERCATOR_MAX_ZOOM and level_resolution(zoom) > source_resolution \
+            and not math.isclose(level_resolution(zoom), source_resolution, rel_tol=1e-8):
+        zoom += 1
+    if zoom > 0 and not math.isclose(level_resolution(zoom), source_resolution, rel_tol=1e-8) \
+            and level_resolution(zoom - 1) / source_resolution < source_resolution / level_resolution(zoom):
+        zoom -= 1
+    return level_resolution(zoom)
 
-    # Calculate statistics
-    data_min = float(data_array.min().values)
-    data_max = float(data_array.max().values)
-    data_mean = float(data_array.mean().values)
-    data_std = float(data_array.std().values)
+
+def describe_output_grid(data_array: xr.DataArray, cog_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Footprint (EPSG:4326 bounds of the data), CRS and resolution of the COG written with `cog_options`.
+
+    Derived from the source grid instead of reopening the file. The
+    webmercator profile's tiling scheme makes GDAL warp to EPSG:3857; the
+    footprint stays the data extent, not the tile-aligned padded extent.
+    """
+    grid = {"bounds": list(data_array.rio.transform_bounds("EPSG:4326"))}
+    if cog_options.get("tiling_scheme") == "GoogleMapsCompatible":
+        height, width = data_array.shape[-2:]
+        transform, _, _ = calculate_default_transform(
+            data_array.rio.crs, "EPSG:3857", width, height, *data_array.rio.bounds())
+        grid["crs"] = "EPSG:3857"
+        grid["resolution"] = webmercator_zoom_resolution(abs(transform.a), int(cog_options.get("blocksize", 256)))
+    else:
+        xres, yres = data_array.rio.resolution()
+        grid["crs"] = data_array.rio.crs.to_string()
+        grid["resolution"] = float(max(abs(xres), abs(yres)))
+    return grid
+
+
+def add_metadata(
+    data_array: xr.DataArray,
+    stats: Dict[str, Any],
+    units: str = "W/m^2",
+    data_type: str = "irradiance") -> Tuple[xr.DataArray, Tuple[float, float, float]]:
+
+    data_min, data_max, data_mean = stats["min"], stats["max"], stats["mean"]
+    valid_percent = 100.0 * stats["count"] / max(stats["count"] + stats["nodata_count"], 1)
     
     # Add metadata
     data_array.attrs.update({
@@ -139,28 +325,161 @@ def add_metadata(data_array: xr.DataArray, units: str = "W/m^2", data_type: str
                 'minimum': data_min,
                 'maximum': data_max,
                 'mean': data_mean,
-                'stddev': data_std
+                'stddev': stats["std"],
+                'valid_percent': valid_percent,
+                'histogram': stats["histogram"]
             }
         }),
     })
     
     return data_array, (data_min, data_max, data_mean)
 
+def resolve_cog_options(
+    profile: Optional[str] = None,
+    compress: Optional[str] = None,
+    blocksize: Optional[int] = None,
+    max_z_error: Optional[float] = None) -> Dict[str, Any]:
+    """Build COG creation options from a profile name plus optional overrides.
+
+    Arguments default to the COG_PROFILE, COG_COMPRESS, COG_BLOCKSIZE and
+    COG_MAX_Z_ERROR environment variables. LERC codecs are lossy with a
+    bounded absolute error of `max_z_error` (in data units).
+    """
+    profile = profile or COG_PROFILE
+    if profile not in COG_PROFILES:
+        raise ValueError(f"Unknown COG profile '{profile}', expected one of {sorted(COG_PROFILES)}")
+    
+    options = dict(COG_PROFILES[profile])
+    compress = compress or COG_COMPRESS
+    if compress:
+        options["compress"] = compress.upper()
+    blocksize = blocksize or COG_BLOCKSIZE
+    if blocksize:
+        options["blocksize"] = int(blocksize)
+    
+    if options["compress"] in LERC_COMPRESSIONS:
+        # LERC does its own prediction
+        options.pop("predictor", None)
+        options["max_z_error"] = COG_MAX_Z_ERROR if max_z_error is None else max_z_error
+    
+    return options
+
+
+def resolve_quantization(
+    dtype: Optional[str] = None,
+    scale_factor: Optional[float] = None,
+    add_offset: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Return the integer encoding to write, or None for float32 output.
+
+    Arguments default to the COG_QUANTIZE ("uint16" / "int16"),
+    COG_SCALE_FACTOR and COG_ADD_OFFSET environment variables. Physical
+    values are recovered as stored * scale_factor + add_offset.
+    """
+    dtype = (dtype if dtype is not None else COG_QUANTIZE).lower()
+    if dtype in ("", "none", "float32"):
+        return None
+    if dtype not in QUANTIZED_NODATA:
+        raise ValueError(f"Unsupported quantized dtype '{dtype}', expected one of {sorted(QUANTIZED_NODATA)}")
+    
+    return {
+        "dtype": dtype,
+        "scale_factor": COG_SCALE_FACTOR if scale_factor is None else scale_factor,
+        "add_offset": COG_ADD_OFFSET if add_offset is None else add_offset,
+        "nodata": QUANTIZED_NODATA[dtype],
+    }
+
+
+def quantize_data_array(data_array: xr.DataArray, quantization: Dict[str, Any]) -> xr.DataArray:
+
+    dtype = np.dtype(quantization["dtype"])
+    nodata = quantization["nodata"]
+    info = np.iinfo(dtype)
+    # Valid codes exclude the reserved NoData code at either end of the range
+    low = info.min + 1 if nodata == info.min else info.min
+    high = info.max - 1 if nodata == info.max else info.max
+    
+    values = data_array.values
+    scaled = np.rint((values - quantization["add_offset"]) / quantization["scale_factor"])
+    np.clip(scaled, low, high, out=scaled)
+    scaled[values == NODATA_VALUE] = nodata
+    
+    quantized = data_array.copy(data=scaled.astype(dtype))
+    quantized.encoding = {"_FillValue": nodata}
+    quantized.attrs.update({
+        "scale_factor": quantization["scale_factor"],
+        "add_offset": quantization["add_offset"],
+    })
+    
+    logger.info(
+        f"Quantized to {dtype.name} with scale_factor={quantization['scale_factor']}, "
+        f"add_offset={quantization['add_offset']}, nodata={nodata}"
+    )
+    return quantized
+
+
+def quantized_cog_options(cog_options: Dict[str, Any], quantization: Dict[str, Any]) -> Dict[str, Any]:
+    """Adapt float COG creation options to an integer encoding."""
+    options = dict(cog_options)
+    options["nodata"] = quantization["nodata"]
+    if options.get("predictor") in ("FLOATING_POINT", 3):
+        options["predictor"] = 2
+    if "max_z_error" in options:
+        # Keep the error bound in physical units
+        options["max_z_error"] = options["max_z_error"] / quantization["scale_factor"]
+    return options
+
+
+def fsync_directory(directory: Path) -> None:
+    """Persist a rename in `directory` (no-op where directories cannot be opened)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def write_cog(
     data_array: xr.DataArray, 
     output_path: Path, 
-    cog_options: Optional[Dict[str, Any]] = None) -> None:
+    cog_options: Optional[Dict[str, Any]] = None,
+    profile: Optional[str] = None,
+    validate: bool = False) -> Dict[str, Any]:
+    """Write a COG atomically and return its grid (see describe_output_grid).
 
+    The file is written to a hidden temp name in the target directory,
+    fsynced, optionally validated, then renamed over `output_path`, so
+    TiTiler and the download endpoints only ever see complete files.
+    """
     if cog_options is None:
-        cog_options = DEFAULT_COG_OPTIONS
+        cog_options = resolve_cog_options(profile)
     
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp-{os.getpid()}")
     logger.info(f"Creating COG file: {output_path}")
     
     try:
-        data_array.rio.to_raster(output_path, **cog_options)
+        with metrics.span("write"):
+            data_array.rio.to_raster(tmp_path, **cog_options)
+            with open(tmp_path, "rb") as f:
+                os.fsync(f.fileno())
+        if validate:
+            with metrics.span("validate"):
+                validate_cog(tmp_path)
+        with metrics.span("publish"):
+            os.replace(tmp_path, output_path)
+            fsync_directory(output_path.parent)
         logger.info("COG creation successful")
+        return describe_output_grid(data_array, cog_options)
+    except ValueError:
+        raise
     except Exception as e:
         raise IOError(f"Failed to write COG: {str(e)}")
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
 
 # def create_preview(
@@ -181,65 +500,199 @@ def write_cog(
 #     logger.info(f"Preview image saved to: {output_path}")
 
 
-def validate_cog(cog_path: Path) -> None:
+# TIFF tag present in tiled IFDs only; strip-layout IFDs have RowsPerStrip instead
+TIFF_TILE_WIDTH_TAG = 322
+
+
+def tiff_ifd_is_tiled(tiff_path: Path, ifd_offset: int) -> bool:
+    """Whether the IFD at `ifd_offset` stores tiles rather than strips.
+
+    Read from the tags themselves: rasterio's profile reports tiled=False
+    whenever the block width equals the image width, which is also true
+    of a single-tile COG (e.g. 512x512 blocks on a 512 px wide image).
+    """
+    with open(tiff_path, "rb") as f:
+        header = f.read(4)
+        order = "<" if header[:2] == b"II" else ">"
+        bigtiff = struct.unpack(f"{order}H", header[2:4])[0] == 43
+        f.seek(ifd_offset)
+        if bigtiff:
+            count, entry_size = struct.unpack(f"{order}Q", f.read(8))[0], 20
+        else:
+            count, entry_size = struct.unpack(f"{order}H", f.read(2))[0], 12
+        entries = f.read(count * entry_size)
+    tags = {struct.unpack_from(f"{order}H", entries, i * entry_size)[0] for i in range(count)}
+    return TIFF_TILE_WIDTH_TAG in tags
+
 
+def check_cog_compliance(cog_path: Path) -> List[str]:
+    """Return the ways `cog_path` deviates from the COG layout (empty if compliant).
+
+    Checks the layout GDAL records, internal tiling, overview presence,
+    and that the IFDs come first and overview data precedes the full
+    resolution data, so readers get headers and previews without seeking
+    through the whole file.
+    """
+    problems = []
     with rasterio.open(cog_path) as src:
-        logger.info(f"Validating COG file: {cog_path}")
-        logger.info(f"Metadata: {src.meta}")
-        logger.info(f"Tags: {src.tags()}")
-        logger.info(f"NoData value: {src.nodata}")
-        logger.info(f"Image bounds: {src.bounds}")
-        logger.info(f"CRS: {src.crs}")
-        
-        # Sample to verify data
-        window = ((0, 10), (0, 10))
-        sample_data = src.read(1, window=window)
-        logger.info(f"Sample data range: {np.min(sample_data)} to {np.max(sample_data)}")
+        if src.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") != "COG":
+            problems.append("missing LAYOUT=COG ghost header")
 
+        ifd_offset = int(src.get_tag_item("IFD_OFFSET", "TIFF", bidx=1) or 0)
+        block_height, block_width = src.block_shapes[0]
+        if not tiff_ifd_is_tiled(cog_path, ifd_offset):
+            problems.append(f"not internally tiled (blocks {block_height}x{block_width})")
+        elif block_width % 16 or block_height % 16:
+            problems.append(f"block size {block_height}x{block_width} is not a multiple of 16")
 
-def convert_netcdf_to_cog(
-    netcdf_path: Union[str, Path], 
-    variable_name: str, 
-    output_dir: Union[str, Path] = "data/cogs", 
-    time_index: int = 0) -> Tuple[Path, str, float, float]:
+        overviews = src.overviews(1)
+        # Same threshold as rio-cogeo: small images may be a single block without overviews
+        if not overviews and max(src.width, src.height) > 512:
+            problems.append("no overviews")
 
-    # Convert paths to Path objects
-    netcdf_path = Path(netcdf_path)
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Step 1: Open the dataset
-    dataset = open_netcdf_dataset(netcdf_path)
-    
-    # Step 2: Extract the variable data
-    data_array, timestamp = extract_variable_data(dataset, variable_name, time_index)
-    
-    # Step 3: Prepare the data array
-    data_array = prepare_data_array(data_array)
+        ifd_offsets = [ifd_offset]
+        data_offsets = [int(src.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1) or 0)]
+        for level in range(len(overviews)):
+            ifd_offsets.append(int(src.get_tag_item("IFD_OFFSET", "TIFF", bidx=1, ovr=level) or 0))
+            data_offsets.append(int(src.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1, ovr=level) or 0))
+        if ifd_offsets != sorted(ifd_offsets):
+            problems.append(f"IFDs out of order: {ifd_offsets}")
+        if data_offsets != sorted(data_offsets, reverse=True):
+            problems.append(f"overview data does not precede full resolution data: {data_offsets}")
+    return problems
+
+
+def should_validate(cog_path: Path, policy: Optional[str] = None, sample_percent: Optional[float] = None) -> bool:
+    """Apply the COG_VALIDATION policy; sampling is deterministic per file name."""
+    policy = (policy or COG_VALIDATION).lower()
+    if policy == "off":
+        return False
+    if policy == "full":
+        return True
+    if policy != "sampled":
+        raise ValueError(f"Unknown COG_VALIDATION '{policy}', expected off, sampled or full")
+    percent = COG_VALIDATION_SAMPLE_PERCENT if sample_percent is None else sample_percent
+    return zlib.crc32(Path(cog_path).name.encode()) % 10000 < percent * 100
+
+
+def validate_cog(cog_path: Path) -> None:
+    """Raise ValueError if the written file is not a compliant COG."""
+    problems = check_cog_compliance(cog_path)
+    if problems:
+        raise ValueError(f"{cog_path} is not a valid COG: {'; '.join(problems)}")
+    logger.info(f"Validated COG file: {cog_path}")
+
+
+def content_digest(data_array: xr.DataArray, cog_options: Dict[str, Any]) -> str:
+    """Short hash of everything that ends up in the COG: values, grid, metadata and creation options."""
+    digest = hashlib.blake2b(digest_size=CONTENT_HASH_BYTES)
+    digest.update(np.ascontiguousarray(data_array.values).tobytes())
+    digest.update(str(data_array.dtype).encode())
+    digest.update(json.dumps({
+        "shape": data_array.shape,
+        "transform": list(data_array.rio.transform())[:6],
+        "crs": data_array.rio.crs.to_wkt() if data_array.rio.crs else None,
+        "attrs": data_array.attrs,
+        "encoding": {k: v for k, v in data_array.encoding.items() if k in ("_FillValue", "dtype")},
+        "cog_options": cog_options,
+    }, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def convert_data_array(
+    data_array: xr.DataArray,
+    variable_name: str,
+    timestamp: str,
+    output_dir: Path,
+    cog_options: Optional[Dict[str, Any]] = None,
+    quantization: Optional[Dict[str, Any]] = None) -> Tuple[Path, str, float, float, Dict[str, Any]]:
+
+    # Step 3: Prepare the data array and compute its statistics
+    data_array, stats = prepare_data_array(data_array)
     
     # Step 4: Add metadata
-    data_array, (data_min, data_max, data_mean) = add_metadata(data_array)
+    with metrics.span("metadata"):
+        data_array, (data_min, data_max, data_mean) = add_metadata(data_array, stats)
     
-    # Step 5: Define output paths
-    cog_path = output_dir / f"{variable_name}_{timestamp}.tif"
+    # Step 4b: Optionally store as scaled integers
+    if cog_options is None:
+        cog_options = resolve_cog_options()
+    if quantization is None:
+        quantization = resolve_quantization()
+    if quantization is not None:
+        with metrics.span("quantize"):
+            data_array = quantize_data_array(data_array, quantization)
+            cog_options = quantized_cog_options(cog_options, quantization)
+    
+    # Step 5: Define output paths; the content hash makes each version of a frame a new, immutable file
+    with metrics.span("hash"):
+        stats["content_hash"] = content_digest(data_array, cog_options)
+    cog_path = output_dir / f"{variable_name}_{timestamp}_{stats['content_hash']}.tif"
     # preview_path = output_dir / f"{variable_name}_{timestamp}_preview.png"
     
-    # Step 6: Write the COG
-    write_cog(data_array, cog_path)
+    # Step 6: Write the COG, validated (step 8) before it becomes visible
+    stats.update(write_cog(data_array, cog_path, cog_options, validate=should_validate(cog_path)))
+    metrics.add("cog_bytes_written", cog_path.stat().st_size)
+    metrics.add("frames_converted")
     
     # Step 7: Create a preview image
     # create_preview(data_array, preview_path, variable_name, timestamp, (data_min, data_max))
     
-    # Step 8: Validate the COG
-    validate_cog(cog_path)
-    
     # Output rescale values for TiTiler
     logger.info(f"Rescale values for visualization: {data_min},{data_max}")
     logger.info(f"Recommended TiTiler parameters: colormap=magma&rescale={data_min},{data_max}")
     
-    return cog_path, timestamp, data_min, data_max
+    return cog_path, timestamp, data_min, data_max, stats
+
+
+def convert_netcdf_to_cog(
+    netcdf_path: Union[str, Path], 
+    variable_name: str, 
+    output_dir: Union[str, Path] = "data/cogs", 
+    time_index: int = 0,
+    cog_options: Optional[Dict[str, Any]] = None,
+    quantization: Optional[Dict[str, Any]] = None) -> Tuple[Path, str, float, float, Dict[str, Any]]:
+
+    # Convert paths to Path objects
+    netcdf_path = Path(netcdf_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Step 1: Open the dataset
+    with open_netcdf_dataset(netcdf_path) as dataset:
+        # Step 2: Extract the variable data
+        data_array, timestamp = extract_variable_data(dataset, variable_name, time_index)
+        
+        return convert_data_array(data_array, variable_name, timestamp, output_dir, cog_options, quantization)
+
+
+def convert_netcdf_to_cogs(
+    netcdf_path: Union[str, Path],
+    variable_name: str,
+    output_dir: Union[str, Path] = "data/cogs",
+    time_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
+    cog_options: Optional[Dict[str, Any]] = None,
+    quantization: Optional[Dict[str, Any]] = None) -> List[Tuple[Path, str, float, float, Dict[str, Any]]]:
+    """Convert every time step (or the `time_range` index slice) of a NetCDF file to one COG each.
+
+    The dataset is opened once; with dask available it is chunked per time
+    step so only the slice being converted is ever loaded into memory.
+    """
+    netcdf_path = Path(netcdf_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    chunks = {"time": 1} if HAS_DASK else None
+    results = []
+    with open_netcdf_dataset(netcdf_path, chunks=chunks) as dataset:
+        for data_array, timestamp in iter_time_slices(dataset, variable_name, time_range):
+            results.append(convert_data_array(
+                data_array, variable_name, timestamp, output_dir, cog_options, quantization))
+    
+    logger.info(f"Converted {len(results)} time steps from {netcdf_path.name}")
+    return results
 
 # if __name__ == "__main__":
-#     cog_path, timestamp, min_val, max_val = convert_netcdf_to_cog("data/netcdf/SISGHI-No-Horizon_2024-01-03T105743.nc", "SISGHI-No-Horizon")
+#     cog_path, timestamp, min_val, max_val, stats = convert_netcdf_to_cog("data/netcdf/SISGHI-No-Horizon_2024-01-03T105743.nc", "SISGHI-No-Horizon")
 #     logger.info(f"File saved to: {cog_path}")
 #     logger.info(f"Timestamp: {timestamp}")
\ No newline at end of file
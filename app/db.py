@@ -1,8 +1,31 @@
-from sqlalchemy import create_engine, Column, Integer, Float, String, Date, DateTime, Text
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, Float, String, Date, DateTime, Text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
+import re
 
-engine = create_engine(os.environ["DATABASE_URL"], pool_pre_ping=True)
+DATABASE_URL = os.environ["DATABASE_URL"]
+
+# Connection pool settings, shared by the sync (ingest, startup) and async (API) engines
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def pool_options(url):
+    """Pool arguments for `url`; SQLite's default pools do not take sizing options."""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -12,4 +35,220 @@ class MapRecord(Base):
     acquisition_datetime = Column(DateTime)
     filepath = Column(Text)
     vmin = Column(Float)
-    vmax = Column(Float)
\ No newline at end of file
+    vmax = Column(Float)
+    vmean = Column(Float)
+    vstd = Column(Float)
+    valid_pixels = Column(Integer)
+    variable = Column(String)
+    # Footprint in EPSG:4326; crs/resolution describe the grid of the written COG
+    xmin = Column(Float)
+    ymin = Column(Float)
+    xmax = Column(Float)
+    ymax = Column(Float)
+    crs = Column(String)
+    resolution = Column(Float)
+    # Hash in the COG file name; a reprocessed frame gets a new file and URL
+    content_hash = Column(String)
+
+    __table_args__ = (
+        # One record per frame; also the conflict target of upsert_map_records()
+        Index("uq_maps_variable_datetime", "variable", "acquisition_datetime", unique=True),
+        Index("ix_maps_datetime", "acquisition_datetime"),
+    )
+
+
+class CatalogVersion(Base):
+    """Single row counter bumped by every ingest commit that changes `maps`."""
+    __tablename__ = "catalog_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+def bump_catalog_version(session):
+    """Increment the catalog version inside the caller's transaction."""
+    updated = session.execute(text("UPDATE catalog_version SET version = version + 1 WHERE id = 1")).rowcount
+    if not updated:
+        session.add(CatalogVersion(id=1, version=1))
+
+
+# Rows per INSERT statement, well below the bind parameter limits of PostgreSQL and SQLite
+UPSERT_CHUNK_SIZE = int(os.getenv("DB_UPSERT_CHUNK_SIZE", "1000"))
+
+
+def upsert_map_records(session, rows):
+    """Insert or update `maps` rows keyed on (variable, acquisition_datetime).
+
+    Uses one multi-row INSERT ... ON CONFLICT DO UPDATE per chunk on
+    PostgreSQL and SQLite, and per-row merges on other databases.
+    Does not commit.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for row in rows:
+            existing = session.query(MapRecord).filter_by(
+                variable=row["variable"], acquisition_datetime=row["acquisition_datetime"]).first()
+            session.merge(MapRecord(id=existing.id if existing else None, **row))
+        return len(rows)
+
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        chunk = rows[start:start + UPSERT_CHUNK_SIZE]
+        statement = insert(MapRecord).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=["variable", "acquisition_datetime"],
+            set_={name: statement.excluded[name] for name in chunk[0]
+                  if name not in ("variable", "acquisition_datetime")},
+        )
+        session.execute(statement)
+    return len(rows)
+
+
+async def get_catalog_version(session):
+    return (await session.scalar(text("SELECT version FROM catalog_version WHERE id = 1"))) or 0
+
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+_async_engine = None
+_async_session_factory = None
+# Pool events of the async engine, exposed by pool_metrics()
+pool_counters = {"connects": 0, "checkouts": 0, "invalidations": 0}
+
+
+def async_database_url(url=DATABASE_URL):
+    """Swap the sync driver of DATABASE_URL for its asyncio counterpart."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def _count_event(name):
+    def listener(*args):
+        pool_counters[name] += 1
+    return listener
+
+
+def get_async_engine():
+    """Async engine used by the API, created on first use so ingest does not need asyncpg."""
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        _async_engine = create_async_engine(
+            async_database_url(), pool_pre_ping=True, **pool_options(DATABASE_URL))
+        _async_session_factory = async_sessionmaker(_async_engine, expire_on_commit=False)
+        event.listen(_async_engine.sync_engine.pool, "connect", _count_event("connects"))
+        event.listen(_async_engine.sync_engine.pool, "checkout", _count_event("checkouts"))
+        event.listen(_async_engine.sync_engine.pool, "invalidate", _count_event("invalidations"))
+    return _async_engine
+
+
+async def get_session():
+    """FastAPI dependency: one async session per request, always closed afterwards."""
+    get_async_engine()
+    async with _async_session_factory() as session:
+        yield session
+
+
+def pool_metrics():
+    """Utilization of the API's connection pool in Prometheus text format."""
+    pool = get_async_engine().sync_engine.pool
+    gauges = {
+        "db_pool_size": getattr(pool, "size", lambda: 0)(),
+        "db_pool_checked_out": getattr(pool, "checkedout", lambda: 0)(),
+        "db_pool_checked_in": getattr(pool, "checkedin", lambda: 0)(),
+        "db_pool_overflow": max(getattr(pool, "overflow", lambda: 0)(), 0),
+        "db_pool_max_overflow": DB_MAX_OVERFLOW,
+    }
+    lines = []
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, value in pool_counters.items():
+        metric = f"db_pool_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def detect_spatial_backend(bind=engine):
+    """Return "postgis", "box" (core PostgreSQL GiST on box) or "none" for other databases."""
+    if bind.dialect.name != "postgresql":
+        return "none"
+    with bind.connect() as conn:
+        has_postgis = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'postgis'")).first()
+    return "postgis" if has_postgis else "box"
+
+
+def create_spatial_index(bind=engine):
+    """Index the maps footprint with PostGIS if installed, otherwise an R-tree (GiST) over a box."""
+    backend = detect_spatial_backend(bind)
+    with bind.begin() as conn:
+        if backend == "postgis":
+            conn.execute(text(
+                "ALTER TABLE maps ADD COLUMN IF NOT EXISTS footprint geometry(Polygon, 4326) "
+                "GENERATED ALWAYS AS (ST_MakeEnvelope(xmin, ymin, xmax, ymax, 4326)) STORED"
+            ))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maps_footprint ON maps USING GIST (footprint)"))
+        elif backend == "box":
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_maps_footprint_box ON maps "
+                "USING GIST (box(point(xmin, ymin), point(xmax, ymax)))"
+            ))
+    return backend
+
+
+# COG file names are {variable}_{timestamp}.tif, with a _{content hash} suffix since hashing was added
+HASH_SUFFIX = re.compile(r"_[0-9a-f]{12}$")
+
+
+def variable_from_cog_name(filepath):
+    """Variable of a COG from its file name, or $VARIABLE if the name does not carry one."""
+    stem = os.path.splitext(os.path.basename(filepath or ""))[0]
+    stem = HASH_SUFFIX.sub("", stem)
+    if "_" in stem:
+        return stem.rsplit("_", 1)[0]
+    return os.getenv("VARIABLE")
+
+
+def init_db(bind=engine):
+    """Create missing tables, columns and indexes introduced after a table was created."""
+    Base.metadata.create_all(bind=bind)
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+        # Rows from before the variable column are NULL there, which the unique index treats
+        # as distinct, so re-ingesting their frames added a second row; fill it in, dropping
+        # legacy rows whose frame was already recorded again
+        legacy = [{"id": row_id, "variable": variable_from_cog_name(filepath)}
+                  for row_id, filepath in conn.execute(text("SELECT id, filepath FROM maps WHERE variable IS NULL"))]
+        if legacy:
+            conn.execute(text(
+                "DELETE FROM maps WHERE id = :id AND EXISTS (SELECT 1 FROM maps AS newer WHERE "
+                "newer.variable = :variable AND newer.acquisition_datetime = maps.acquisition_datetime)"
+            ), legacy)
+            conn.execute(text("UPDATE maps SET variable = :variable WHERE id = :id"), legacy)
+
+        maps_indexes = {index["name"] for index in inspector.get_indexes("maps")}
+        if "uq_maps_variable_datetime" not in maps_indexes:
+            # Older tables allowed duplicate frames; keep the latest row of each
+            conn.execute(text(
+                "DELETE FROM maps WHERE id NOT IN "
+                "(SELECT MAX(id) FROM maps GROUP BY variable, acquisition_datetime)"
+            ))
+        if "ix_maps_variable_datetime" in maps_indexes:
+            # Superseded by the unique index on the same columns
+            conn.execute(text("DROP INDEX ix_maps_variable_datetime"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+    return create_spatial_index(bind)
@@ -0,0 +1,278 @@
+import io
+import os
+import shutil
+import logging
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+logger = logging.getLogger(__name__)
+
+# Records store the path TiTiler sees; the backend mounts the same files under COG_DIR
+# (relative to the app directory, like the other data/ paths)
+TITILER_COG_PREFIX = "/opt/cogs/"
+COG_DIR = os.getenv("COG_DIR", "data/cogs")
+# Frames read and written per step when building NetCDF/Zarr cubes
+CUBE_BATCH_SIZE = int(os.getenv("DOWNLOAD_CUBE_BATCH_SIZE", "24"))
+CUBE_SPATIAL_CHUNK = 256
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def resolve_local_path(filepath: str) -> str:
+    """Map a TiTiler path from the DB to the backend's local path."""
+    if filepath.startswith(TITILER_COG_PREFIX):
+        return os.path.join(COG_DIR, filepath[len(TITILER_COG_PREFIX):])
+    return filepath
+
+
+def bbox_window(src, bbox: Tuple[float, float, float, float]) -> Optional[Window]:
+    """Pixel window of `src` covering an EPSG:4326 bbox, or None if they do not intersect."""
+    bounds = bbox
+    if src.crs and src.crs.to_epsg() != 4326:
+        bounds = transform_bounds("EPSG:4326", src.crs, *bbox)
+    try:
+        window = from_bounds(*bounds, transform=src.transform)
+        window = window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+    window = window.round_offsets().round_lengths()
+    if window.width < 1 or window.height < 1:
+        return None
+    return window
+
+
+def clip_to_geotiff(path: str, bbox: Tuple[float, float, float, float]) -> Optional[bytes]:
+    """Read only the bbox window of a COG and encode it as a small GeoTIFF."""
+    with rasterio.open(path) as src:
+        window = bbox_window(src, bbox)
+        if window is None:
+            return None
+        data = src.read(window=window)
+        profile = src.profile
+        profile.update(
+            driver="GTiff",
+            width=int(window.width),
+            height=int(window.height),
+            transform=src.window_transform(window),
+            compress="DEFLATE",
+        )
+        # Block sizes of the source do not apply to the clipped raster
+        for key in ("tiled", "blockxsize", "blockysize", "interleave"):
+            profile.pop(key, None)
+
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(data)
+                dst.update_tags(**src.tags())
+                dst.scales = src.scales
+                dst.offsets = src.offsets
+            return memfile.read()
+
+
+class StreamBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink that hands out what has been written so far.
+
+    zipfile detects that it cannot seek and writes data descriptors instead,
+    so an archive can be produced incrementally.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_clipped_zip(filepaths: Iterable[str], bbox: Tuple[float, float, float, float]) -> Iterator[bytes]:
+    """Yield a ZIP archive of the COGs clipped to `bbox`, one file at a time.
+
+    Only one clipped raster is held in memory at any point, so memory use
+    does not depend on the length of the time range.
+    """
+    buffer = StreamBuffer()
+    written = 0
+    # GeoTIFFs are already compressed, so the archive only stores them
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for filepath in filepaths:
+            path = resolve_local_path(filepath)
+            try:
+                content = clip_to_geotiff(path, bbox)
+            except Exception as e:
+                logger.warning(f"⚠️ Skipping {path} in download: {e}")
+                continue
+            if content is None:
+                continue
+            archive.writestr(os.path.basename(path), content)
+            written += 1
+            yield buffer.drain()
+    yield buffer.drain()
+    logger.info(f"✅ Streamed {written} clipped files")
+
+
+def cube_grid(path: str, bbox: Tuple[float, float, float, float]) -> Optional[dict]:
+    """Grid of the bbox window in the first file; all frames are read onto it."""
+    with rasterio.open(path) as src:
+        window = bbox_window(src, bbox)
+        if window is None:
+            return None
+        transform = src.window_transform(window)
+        height, width = int(window.height), int(window.width)
+        return {
+            "crs": src.crs,
+            "transform": transform,
+            "height": height,
+            "width": width,
+            "bounds": rasterio.windows.bounds(Window(0, 0, width, height), transform),
+            "x": transform.c + transform.a * (np.arange(width) + 0.5),
+            "y": transform.f + transform.e * (np.arange(height) + 0.5),
+        }
+
+
+def read_frame(path: str, grid: dict) -> np.ndarray:
+    """Read the grid window of one COG as physical float32 values with NaN for NoData."""
+    with rasterio.open(path) as src:
+        window = from_bounds(*grid["bounds"], transform=src.transform)
+        data = src.read(1, window=window, out_shape=(grid["height"], grid["width"]),
+                        boundless=True, masked=True)
+        values = data.astype(np.float32) * src.scales[0] + src.offsets[0]
+        return values.filled(np.nan)
+
+
+def iter_frame_batches(records: List[Tuple[datetime, str]], grid: dict) -> Iterator[Tuple[List[datetime], np.ndarray]]:
+    """Yield (times, stack) batches of at most CUBE_BATCH_SIZE frames."""
+    for start in range(0, len(records), CUBE_BATCH_SIZE):
+        batch = records[start:start + CUBE_BATCH_SIZE]
+        frames = []
+        times = []
+        for acquisition_datetime, filepath in batch:
+            try:
+                frames.append(read_frame(resolve_local_path(filepath), grid))
+                times.append(acquisition_datetime)
+            except Exception as e:
+                logger.warning(f"⚠️ Skipping {filepath} in cube: {e}")
+        if frames:
+            yield times, np.stack(frames)
+
+
+def write_netcdf_cube(records, grid, variable: str, path: str) -> None:
+    """Write a compressed, chunked (time, y, x) NetCDF, appending batch by batch."""
+    import netCDF4
+
+    with netCDF4.Dataset(path, "w", format="NETCDF4") as nc:
+        nc.createDimension("time", None)
+        nc.createDimension("y", grid["height"])
+        nc.createDimension("x", grid["width"])
+
+        time_var = nc.createVariable("time", "f8", ("time",))
+        time_var.units = "seconds since 1970-01-01 00:00:00"
+        time_var.calendar = "standard"
+        nc.createVariable("y", "f8", ("y",))[:] = grid["y"]
+        nc.createVariable("x", "f8", ("x",))[:] = grid["x"]
+        crs_var = nc.createVariable("spatial_ref", "i4")
+        crs_var.crs_wkt = grid["crs"].to_wkt()
+
+        chunks = (
+            min(CUBE_BATCH_SIZE, len(records)),
+            min(CUBE_SPATIAL_CHUNK, grid["height"]),
+            min(CUBE_SPATIAL_CHUNK, grid["width"]),
+        )
+        data_var = nc.createVariable(variable, "f4", ("time", "y", "x"), zlib=True, complevel=4,
+                                     shuffle=True, chunksizes=chunks, fill_value=np.nan)
+        data_var.grid_mapping = "spatial_ref"
+
+        offset = 0
+        for times, stack in iter_frame_batches(records, grid):
+            # Acquisition datetimes are stored naive in UTC
+            time_var[offset:offset + len(times)] = np.array(times, dtype="datetime64[s]").astype(np.int64)
+            data_var[offset:offset + len(times)] = stack
+            offset += len(times)
+
+
+def write_zarr_cube(records, grid, variable: str, path: str) -> None:
+    """Write a chunked (time, y, x) Zarr store, appending batch by batch."""
+    import xarray as xr
+
+    chunks = (
+        min(CUBE_BATCH_SIZE, len(records)),
+        min(CUBE_SPATIAL_CHUNK, grid["height"]),
+        min(CUBE_SPATIAL_CHUNK, grid["width"]),
+    )
+    first = True
+    for times, stack in iter_frame_batches(records, grid):
+        batch = xr.Dataset(
+            {variable: (("time", "y", "x"), stack)},
+            coords={"time": np.array(times, dtype="datetime64[ns]"), "y": grid["y"], "x": grid["x"]},
+        )
+        batch[variable].attrs["crs_wkt"] = grid["crs"].to_wkt()
+        if first:
+            batch.to_zarr(path, mode="w", encoding={variable: {"chunks": chunks}})
+            first = False
+        else:
+            batch.to_zarr(path, append_dim="time")
+
+
+def iter_file(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            yield chunk
+
+
+def iter_directory_zip(directory: str) -> Iterator[bytes]:
+    """Stream a directory (e.g. a Zarr store) as an uncompressed ZIP."""
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, directory))
+                yield buffer.drain()
+    yield buffer.drain()
+
+
+def stream_cube(records: List[Tuple[datetime, str]], bbox: Tuple[float, float, float, float],
+                variable: str, cube_format: str) -> Iterator[bytes]:
+    """Build a single (time, y, x) cube of the bbox in a temp dir and stream it back.
+
+    Frames are read and written CUBE_BATCH_SIZE at a time, so memory is
+    bounded by one batch of clipped frames regardless of the time range.
+    """
+    records = sorted(records)
+    tmp_dir = tempfile.mkdtemp(prefix="cube-")
+    try:
+        grid = None
+        for _, filepath in records:
+            grid = cube_grid(resolve_local_path(filepath), bbox)
+            if grid is not None:
+                break
+        if grid is None:
+            logger.info("No files intersect the requested bbox")
+            return
+
+        if cube_format == "netcdf":
+            path = os.path.join(tmp_dir, f"{variable}.nc")
+            write_netcdf_cube(records, grid, variable, path)
+            yield from iter_file(path)
+        else:
+            path = os.path.join(tmp_dir, f"{variable}.zarr")
+            write_zarr_cube(records, grid, variable, path)
+            yield from iter_directory_zip(path)
+        logger.info(f"✅ Streamed {cube_format} cube of {len(records)} frames")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -1,9 +1,26 @@
 import os
+import re
 import time
 import logging
+import shutil
+import argparse
+import signal
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from convert import convert_netcdf_to_cog
-from db import SessionLocal, MapRecord
+from pathlib import Path
+from convert import convert_netcdf_to_cogs, resolve_cog_options, resolve_quantization, DATETIME_FORMAT
+from manifest import IngestManifest
+from tiles import PRERENDER_TILES, TILE_CACHE_DIR, render_tile_pyramid
+from timeseries import TIMESERIES_ENABLED, append_frames
+from cogindex import append_entries, ensure_index
+from metrics import metrics, peak_rss_bytes
+from watcher import DirectoryWatcher
+from jobqueue import JobQueue, worker_id
+from db import SessionLocal, bump_catalog_version, upsert_map_records
 from sqlalchemy.exc import OperationalError
 from sqlalchemy import text
 
@@ -16,84 +33,540 @@ logger = logging.getLogger(__name__)
 
 VARIABLE = os.environ["VARIABLE"]
 DATA_DIR = os.environ["DATA_DIR"]
+MANIFEST_PATH = os.getenv("INGEST_MANIFEST", "data/ingest_manifest.json")
 
-def ingest_new_data():
-    # Retry database connection
-    for i in range(5):
+# Parallel ingest settings
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Upper bound on the estimated memory of conversions running at the same time
+INGEST_MAX_INFLIGHT_MB = float(os.getenv("INGEST_MAX_INFLIGHT_MB", "2048"))
+# In-memory size of a conversion relative to the NetCDF file size (compression, float32 copies)
+INGEST_MEMORY_FACTOR = float(os.getenv("INGEST_MEMORY_FACTOR", "4"))
+INGEST_DB_BATCH_SIZE = int(os.getenv("INGEST_DB_BATCH_SIZE", "100"))
+# Seconds between checks of the job queue when it is empty
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+
+
+def conversion_options():
+    """Everything that changes the produced COG; part of the manifest key."""
+    return {
+        "variable": VARIABLE,
+        "cog_options": resolve_cog_options(),
+        "quantization": resolve_quantization(),
+    }
+
+
+def connect_db(retries=5):
+    """Open a DB session, retrying a few times. Returns None if the DB is unavailable."""
+    for i in range(retries):
         try:
             db = SessionLocal()
-            db.execute(text("SELECT 1"))  # Test connection with proper syntax
-            break
+            with metrics.span("db_connect"):
+                db.execute(text("SELECT 1"))  # Test connection with proper syntax
+            return db
         except OperationalError as e:
-            logger.warning(f"DB connection failed. Retry {i+1}/5... Error: {e}")
-            time.sleep(5)
+            logger.warning(f"DB connection failed. Retry {i+1}/{retries}... Error: {e}")
+            if i < retries - 1:
+                time.sleep(5)
         except Exception as e:
             logger.error(f"Database error: {e}")
             # Continue without database - process files anyway
-            db = None
+            return None
+    logger.error(f"Could not connect to the DB after {retries} retries.")
+    return None
+
+
+def list_pending_files(manifest, force=False, since=None):
+    """Return .nc files in DATA_DIR that still need converting, using stat() only."""
+    pending = []
+    skipped = 0
+    for entry in os.scandir(DATA_DIR):
+        if not entry.name.endswith(".nc") or not entry.is_file():
+            continue
+        st = entry.stat()
+        if force or (since is not None and st.st_mtime >= since.timestamp()):
+            pending.append(entry.path)
+        elif manifest.is_current(entry.path, st):
+            skipped += 1
+        else:
+            pending.append(entry.path)
+    logger.info(f"Found {len(pending)} new or changed files, {skipped} unchanged")
+    return sorted(pending)
+
+
+def to_titiler_path(cog_path):
+    """Map a local COG path to the path TiTiler sees inside its container."""
+    relative_path = os.path.relpath(str(cog_path), "data/cogs")
+    return f"/opt/cogs/{relative_path}"
+
+
+def convert_file(path):
+    """Convert every time step of one NetCDF file.
+
+    Runs in a worker process, so it only returns plain data, including
+    the stage metrics recorded while converting this file.
+    """
+    start = time.perf_counter()
+    metrics_before = metrics.snapshot()
+    frames = [{
+        "cog_path": str(cog_path),
+        "timestamp": timestamp,
+        "vmin": vmin,
+        "vmax": vmax,
+        "vmean": stats["mean"],
+        "vstd": stats["std"],
+        "valid_pixels": stats["count"],
+        "bounds": stats["bounds"],
+        "crs": stats["crs"],
+        "resolution": stats["resolution"],
+        "content_hash": stats["content_hash"],
+    } for cog_path, timestamp, vmin, vmax, stats in convert_netcdf_to_cogs(path, variable_name=VARIABLE)]
+
+    if PRERENDER_TILES:
+        for frame in frames:
+            if frame["vmin"] is None:
+                continue
+            try:
+                with metrics.span("tiles"):
+                    render_tile_pyramid(frame["cog_path"], frame["vmin"], frame["vmax"])
+            except Exception as e:
+                # TiTiler still serves these tiles dynamically
+                logger.warning(f"⚠️ Tile pre-rendering failed for {frame['cog_path']}: {e}")
+    return {
+        "path": path,
+        "frames": frames,
+        "seconds": time.perf_counter() - start,
+        "metrics": metrics.delta(metrics_before),
+        # Lifetime peak of the process that converted the file (a pool worker, or this process)
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def estimate_memory(path):
+    """Rough estimate of the bytes a conversion of `path` keeps in memory."""
+    return os.path.getsize(path) * INGEST_MEMORY_FACTOR
+
+
+def create_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def run_conversions(paths, workers=1, pool=None):
+    """Yield (path, result, error) for each file, converting up to `workers` files at once.
+
+    New files are only submitted while the estimated memory of the
+    conversions in flight stays under INGEST_MAX_INFLIGHT_MB, so a backfill
+    of large cubes cannot exhaust the container. One file is always allowed
+    so that a single oversized file still gets processed. A `pool` passed
+    in is reused and left running (the --watch daemon keeps one warm).
+    """
+    if workers <= 1:
+        for path in paths:
+            try:
+                yield path, convert_file(path), None
+            except Exception as e:
+                yield path, None, e
+        return
+
+    if pool is None:
+        with create_pool(workers) as pool:
+            yield from run_conversions(paths, workers, pool)
+        return
+
+    budget = INGEST_MAX_INFLIGHT_MB * 1024 * 1024
+    queue = deque(paths)
+    in_flight = {}
+    in_flight_bytes = 0
+    while queue or in_flight:
+        while queue and len(in_flight) < workers:
+            cost = estimate_memory(queue[0])
+            if in_flight and in_flight_bytes + cost > budget:
+                break
+            path = queue.popleft()
+            try:
+                future = pool.submit(convert_file, path)
+            except BrokenProcessPool as e:
+                # A worker died; fail what is left so the caller can replace the pool
+                for failed in [path, *queue]:
+                    yield failed, None, e
+                queue.clear()
+                break
+            in_flight[future] = (path, cost)
+            in_flight_bytes += cost
+
+        if not in_flight:
             break
-    else:
-        logger.error("Could not connect to the DB after 5 retries.")
-        db = None
-    
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            path, cost = in_flight.pop(future)
+            in_flight_bytes -= cost
+            try:
+                result = future.result()
+            except Exception as e:
+                yield path, None, e
+                continue
+            # Serial conversions record into this process's metrics directly
+            metrics.merge(result["metrics"])
+            yield path, result, None
+
+
+def flush_records(db, batch, manifest):
+    """Upsert a batch of converted files into the DB with a single commit."""
+    if not batch:
+        return 0
+    # Keyed on the unique (variable, acquisition_datetime); a later frame wins within the batch
+    rows = {}
+    for result in batch:
+        for frame in result["frames"]:
+            acquisition_datetime = datetime.strptime(frame["timestamp"], DATETIME_FORMAT)
+            rows[acquisition_datetime] = {
+                "acquisition_datetime": acquisition_datetime,
+                "filepath": to_titiler_path(frame["cog_path"]),
+                "vmin": frame["vmin"],
+                "vmax": frame["vmax"],
+                "vmean": frame["vmean"],
+                "vstd": frame["vstd"],
+                "valid_pixels": frame["valid_pixels"],
+                "variable": VARIABLE,
+                "xmin": frame["bounds"][0],
+                "ymin": frame["bounds"][1],
+                "xmax": frame["bounds"][2],
+                "ymax": frame["bounds"][3],
+                "crs": frame["crs"],
+                "resolution": frame["resolution"],
+                "content_hash": frame["content_hash"],
+            }
+    try:
+        with metrics.span("db_upsert"):
+            if rows:
+                upsert_map_records(db, list(rows.values()))
+                # Invalidates the /timestamps cache of every backend worker
+                bump_catalog_version(db)
+            db.commit()
+        metrics.add("frames_recorded", len(rows))
+    except Exception as db_error:
+        db.rollback()
+        logger.error(f"⚠️ Database operation failed for batch of {len(batch)} files: {db_error}")
+        logger.info("✅ Files converted but not recorded in database")
+        return 0
+
+    if manifest is not None:
+        for result in batch:
+            manifest.record(result["path"], frames=len(result["frames"]))
+    logger.info(f"✅ Recorded batch of {len(batch)} files ({len(rows)} frames) in database")
+    return len(batch)
+
+
+def flush_timeseries(batch):
+    """Append a batch of converted frames to the time-major store behind /timeseries."""
+    if not TIMESERIES_ENABLED or not batch:
+        return 0
+    frames = sorted(
+        (datetime.strptime(frame["timestamp"], DATETIME_FORMAT), frame["cog_path"])
+        for result in batch for frame in result["frames"]
+    )
+    try:
+        with metrics.span("timeseries_append"):
+            return append_frames(VARIABLE, frames)
+    except Exception as e:
+        # The COGs and DB records are unaffected; a --force run appends or overwrites the frames
+        logger.warning(f"⚠️ Time-series store update failed: {e}")
+        return 0
+
+
+def flush_index(batch):
+    """Append a batch of converted frames to the COG index used when the DB is down."""
+    try:
+        with metrics.span("index_append"):
+            append_entries({
+                "variable": VARIABLE,
+                "datetime": frame["timestamp"],
+                "vmin": frame["vmin"],
+                "vmax": frame["vmax"],
+                "filepath": to_titiler_path(frame["cog_path"]),
+            } for result in batch for frame in result["frames"])
+    except OSError as e:
+        logger.warning(f"⚠️ COG index update failed: {e}")
+
+
+# Content hash at the end of a COG name, see convert.content_digest()
+HASHED_SUFFIX = re.compile(r"[0-9a-f]{12}")
+
+
+def remove_superseded_cogs(batch):
+    """Delete older versions of the frames in `batch` and their pre-rendered tiles.
+
+    COG names carry a content hash, so a reprocessed frame is a new file;
+    the previous one is only removed once nothing references it anymore.
+    """
+    removed = 0
+    for result in batch:
+        for frame in result["frames"]:
+            current = Path(frame["cog_path"])
+            # Only hashed versions: unhashed COGs from before hashing are left alone
+            for old in current.parent.glob(f"{VARIABLE}_{frame['timestamp']}_*.tif"):
+                if old == current or not HASHED_SUFFIX.fullmatch(old.stem.rsplit("_", 1)[1]):
+                    continue
+                old.unlink(missing_ok=True)
+                shutil.rmtree(Path(TILE_CACHE_DIR) / old.stem, ignore_errors=True)
+                removed += 1
+    if removed:
+        logger.info(f"🧹 Removed {removed} superseded COG version(s)")
+    return removed
+
+
+def flush_batch(db, batch, manifest):
+    """Record a batch everywhere; returns whether it made it into the DB."""
+    recorded = db is not None and bool(flush_records(db, batch, manifest))
+    # Old COG versions stay on disk until the DB commit moved every reference off them
+    if recorded:
+        with metrics.span("cleanup"):
+            remove_superseded_cogs(batch)
+    flush_index(batch)
+    flush_timeseries(batch)
+    if manifest is not None:
+        with metrics.span("manifest_save"):
+            manifest.save()
+    return recorded
+
+
+def ingest_new_data(force=False, since=None, workers=INGEST_WORKERS):
+    db = connect_db()
+
     logger.info("🚀 ingest.py is running...")
-    
+
     # Check if data directory exists
     if not os.path.exists(DATA_DIR):
         logger.error(f"Data directory does not exist: {DATA_DIR}")
         return
-    
+
+    manifest = IngestManifest(MANIFEST_PATH, conversion_options())
+    # Index COGs from before the index existed, so appends extend a complete list
+    ensure_index()
+    paths = list_pending_files(manifest, force=force, since=since)
+    ingest_paths(db, manifest, paths, workers)
+    if db is not None:
+        db.close()
+
+
+def ingest_paths(db, manifest, paths, workers=INGEST_WORKERS, pool=None):
+    """Convert `paths`, record them in batches and export the run's metrics.
+
+    Returns the errors raised by the conversions, keyed by path, and the
+    set of paths whose frames were recorded in the DB. `manifest` may be
+    None to leave the files unrecorded.
+    """
+    errors = {}
+    recorded = set()
     processed_count = 0
     error_count = 0
-    
-    for filename in os.listdir(DATA_DIR):
-        if not filename.endswith(".nc"):
-            continue
-            
-        path = os.path.join(DATA_DIR, filename)
-        try:
-            cog_path, timestamp, vmin, vmax = convert_netcdf_to_cog(path, variable_name=VARIABLE)
-            logger.info(f"Converted: {filename} -> {cog_path}")
-            logger.info(f"Timestamp: {timestamp}, Value range: [{vmin}, {vmax}]")
-            
-            # Modify the path to match what titiler expects
-            relative_path = os.path.relpath(str(cog_path), "data/cogs")
-            titiler_path = f"/opt/cogs/{relative_path}"
-            
-            # Only try database operations if we have a connection
-            if db is not None:
-                try:
-                    # Check if already in DB
-                    exists = db.query(MapRecord).filter_by(acquisition_datetime=timestamp).first()
-                    if exists:
-                        logger.info(f"✅ Already ingested: {filename}")
-                        continue
-                        
-                    # Insert into DB
-                    record = MapRecord(
-                        acquisition_datetime=timestamp, 
-                        filepath=titiler_path, 
-                        vmin=float(vmin), 
-                        vmax=float(vmax)
-                    )
-                    db.add(record)
-                    db.commit()
-                    logger.info(f"✅ Ingested: {filename} with path {titiler_path}")
-                except Exception as db_error:
-                    logger.error(f"⚠️ Database operation failed for {filename}: {db_error}")
-                    logger.info(f"✅ File converted but not recorded in database: {filename}")
-            else:
-                logger.info(f"✅ File converted (no database): {filename}")
-                
-            processed_count += 1
-            
-        except Exception as e:
-            logger.error(f"❌ Failed to ingest {filename}: {str(e)}")
+    frame_count = 0
+    bytes_read = 0
+    workers_peak_rss = 0
+    batch = []
+    start = time.perf_counter()
+
+    logger.info(f"Converting {len(paths)} files with {max(workers, 1)} worker(s)")
+    for path, result, error in run_conversions(paths, workers, pool):
+        filename = os.path.basename(path)
+        if error is not None:
+            logger.error(f"❌ Failed to ingest {filename}: {str(error)}")
             error_count += 1
-            
-    if db is not None:
-        db.close()
+            errors[path] = error
+            continue
+
+        logger.info(f"Converted: {filename} -> {len(result['frames'])} COG(s) in {result['seconds']:.2f}s")
+        for frame in result["frames"]:
+            logger.info(f"Timestamp: {frame['timestamp']}, Value range: [{frame['vmin']}, {frame['vmax']}]")
+        processed_count += 1
+        frame_count += len(result["frames"])
+        bytes_read += os.path.getsize(path)
+        workers_peak_rss = max(workers_peak_rss, result["peak_rss_bytes"])
+
+        if db is None:
+            logger.info(f"✅ File converted (no database): {filename}")
+        batch.append(result)
+        if len(batch) >= INGEST_DB_BATCH_SIZE:
+            if flush_batch(db, batch, manifest):
+                recorded.update(r["path"] for r in batch)
+            batch = []
+
+    if flush_batch(db, batch, manifest):
+        recorded.update(r["path"] for r in batch)
+
+    elapsed = time.perf_counter() - start
+    if processed_count:
+        logger.info(
+            f"Throughput: {processed_count / elapsed:.2f} files/s, "
+            f"{frame_count / elapsed:.2f} frames/s, "
+            f"{bytes_read / 1024 / 1024 / elapsed:.1f} MB/s over {elapsed:.1f}s"
+        )
     logger.info(f"Ingestion complete. Processed: {processed_count}, Errors: {error_count}")
+    write_metrics(elapsed, processed_count, error_count, len(paths), workers_peak_rss)
+    return errors, recorded
+
+
+def process_jobs(queue, owner, db, manifest, workers=INGEST_WORKERS, pool=None, stopping=None):
+    """Claim and convert due jobs of VARIABLE until none are left.
+
+    A job is done once its frames are in the DB; conversion or DB errors
+    count as a failed attempt. Returns the pool, replaced if it broke.
+    """
+    while stopping is None or not stopping():
+        # Two files per process keeps the pool busy while a claimed batch drains
+        jobs = queue.claim(VARIABLE, owner, limit=2 * max(workers, 1))
+        if not jobs:
+            queue.maybe_prune()
+            break
+        # A file rewritten while its previous job was queued has two jobs for one path
+        by_path = {}
+        for job in jobs:
+            by_path.setdefault(job["path"], []).append(job)
+
+        metrics.reset()
+        with queue.hold([job["id"] for job in jobs], owner):
+            errors, recorded = ingest_paths(db, manifest, list(by_path), workers, pool)
+        for path, path_jobs in by_path.items():
+            for job in path_jobs:
+                if path in recorded:
+                    queue.complete(job["id"], owner)
+                else:
+                    queue.fail(job["id"], owner, repr(errors.get(path, "not recorded in the database")))
+        if any(isinstance(e, BrokenProcessPool) for e in errors.values()):
+            # A worker died (e.g. OOM-killed); the failed jobs are retried with backoff
+            logger.warning("⚠️ Conversion pool broke, starting a new one")
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = create_pool(workers)
+    return pool
+
+
+def watch_data_dir(workers=INGEST_WORKERS):
+    """Daemon mode: convert files as soon as they settle in DATA_DIR.
+
+    New files go through the job queue, which this process then drains
+    together with any `--worker` processes. The DB session, the manifest
+    and (with several workers) the conversion pool stay alive between
+    cycles, so a new file only pays for its own conversion instead of
+    interpreter start-up, imports and DB connect.
+    """
+    if not os.path.exists(DATA_DIR):
+        logger.error(f"Data directory does not exist: {DATA_DIR}")
+        return
+
+    manifest = IngestManifest(MANIFEST_PATH, conversion_options())
+    ensure_index()
+    db = connect_db()
+    watcher = DirectoryWatcher(DATA_DIR)
+    pool = create_pool(workers) if workers > 1 else None
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: watcher.stop())
+
+    queue = JobQueue()
+    owner = worker_id()
+    logger.info(f"🚀 ingest.py is watching {DATA_DIR} with {max(workers, 1)} worker(s)")
+    try:
+        # Also wakes up every JOB_POLL_SECONDS for jobs queued by HeMu or other watchers
+        for paths in watcher.batches(idle_every=JOB_POLL_SECONDS):
+            # Files converted by `--worker` processes are recorded by them
+            manifest.refresh()
+            pending = []
+            for path in paths:
+                try:
+                    if not manifest.is_current(path):
+                        pending.append(path)
+                except FileNotFoundError:
+                    continue
+            if pending:
+                queue.enqueue(VARIABLE, pending)
+            if db is None:
+                db = connect_db(retries=1)
+            # Jobs wait in the queue while the DB is down
+            if db is not None:
+                pool = process_jobs(queue, owner, db, manifest, workers, pool, lambda: not watcher.running)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if db is not None:
+            db.close()
+        watcher.close()
+        logger.info("👋 Ingest watcher stopped")
+
+
+def work_queue(workers=INGEST_WORKERS):
+    """Worker mode: convert jobs from the shared queue until stopped.
+
+    Any number of workers (in one or several containers) can run next to
+    the watcher; leases keep them from converting the same file twice.
+    Converted files go into the shared manifest, so the watcher does not
+    queue them again.
+    """
+    manifest = IngestManifest(MANIFEST_PATH, conversion_options())
+    ensure_index()
+    queue = JobQueue()
+    owner = worker_id()
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    pool = create_pool(workers) if workers > 1 else None
+    db = None
+
+    logger.info(f"🚀 ingest.py worker {owner} is serving {VARIABLE} jobs with {max(workers, 1)} process(es)")
+    try:
+        while not stopping.is_set():
+            if db is None:
+                db = connect_db(retries=1)
+            if db is not None:
+                pool = process_jobs(queue, owner, db, manifest, workers, pool, stopping.is_set)
+            stopping.wait(JOB_POLL_SECONDS)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if db is not None:
+            db.close()
+        logger.info("👋 Ingest worker stopped")
+
+
+def write_metrics(elapsed, processed_count, error_count, pending_count, workers_peak_rss=0):
+    """Export this run's stage timings, byte counts and peak memory as a metrics file."""
+    try:
+        metrics.write(gauges={
+            "files_pending": pending_count,
+            "files_converted": processed_count,
+            "files_failed": error_count,
+            "run_duration_seconds": elapsed,
+            "last_run_timestamp_seconds": time.time(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            # RUSAGE_CHILDREN only counts exited children, not the warm pool's workers
+            "workers_peak_rss_bytes": workers_peak_rss,
+        })
+    except OSError as e:
+        logger.warning(f"⚠️ Could not write metrics file: {e}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert new NetCDF files to COGs and record them in the DB")
+    parser.add_argument("--force", action="store_true",
+                        help="Reprocess every file, ignoring the ingest manifest")
+    parser.add_argument("--since", type=datetime.fromisoformat,
+                        help="Reprocess files modified at or after this ISO datetime")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Number of conversion processes (default: INGEST_WORKERS or 1)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and convert files as they arrive in DATA_DIR")
+    parser.add_argument("--worker", action="store_true",
+                        help="Keep running and convert jobs from the shared job queue")
+    parser.add_argument("--retry-dead", action="store_true",
+                        help="Requeue the dead-lettered jobs of VARIABLE and exit")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    ingest_new_data()
\ No newline at end of file
+    args = parse_args()
+    if args.retry_dead:
+        logger.info(f"Requeued {JobQueue().retry_dead(VARIABLE)} dead job(s)")
+    elif args.worker:
+        work_queue(workers=args.workers)
+    elif args.watch:
+        watch_data_dir(workers=args.workers)
+    else:
+        ingest_new_data(force=args.force, since=args.since, workers=args.workers)
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Conversion jobs shared by the HeMu processor (producer) and ingest workers (consumers).
+# SQLite in WAL mode on the shared data volume; containers must be on the same host
+# (WAL does not work over network filesystems).
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "data/queue/jobs.db")
+# Seconds a claimed job stays reserved for its worker (renewed while it works); expired leases are claimed again
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Retry delay after a failed attempt, doubled with every further attempt
+JOB_RETRY_SECONDS = float(os.getenv("JOB_RETRY_SECONDS", "60"))
+# Done jobs are deleted after this many seconds once their file changed or is gone (dead letters are kept)
+JOB_KEEP_SECONDS = float(os.getenv("JOB_KEEP_SECONDS", str(7 * 24 * 3600)))
+PRUNE_INTERVAL_SECONDS = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL UNIQUE,
+    variable TEXT NOT NULL,
+    path TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_claim ON jobs (variable, state, available_at);
+"""
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_key(variable: str, path: str) -> str:
+    """Identity of a job: the variable and the file's path, size and mtime.
+
+    Enqueueing an unchanged file again is a no-op, whatever state its job
+    is in; a rewritten file gets a new job.
+    """
+    st = os.stat(path)
+    return f"{variable}|{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+
+class JobQueue:
+    """Durable queue of NetCDF files to convert, claimed by workers with leases.
+
+    States: queued -> running -> done, or back to queued (with backoff)
+    after a failure, and dead once JOB_MAX_ATTEMPTS attempts failed. A
+    worker that dies keeps its jobs only until their lease expires.
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_seconds: float = JOB_RETRY_SECONDS):
+        self.path = path or JOB_QUEUE_PATH
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.next_prune = 0.0
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Short-lived connections: safe across threads, forked workers and containers
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            # Take the write lock up front so two workers cannot claim the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def enqueue(self, variable: str, paths: List[str], payload: Optional[Dict[str, Any]] = None) -> int:
+        """Add jobs for `paths`; returns how many were new."""
+        now = time.time()
+        rows = []
+        for path in paths:
+            try:
+                rows.append((job_key(variable, path), variable, os.path.abspath(path),
+                             json.dumps(payload or {}), now, now, now))
+            except FileNotFoundError:
+                logger.warning(f"⚠️ Not queueing missing file {path}")
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT INTO jobs (job_key, variable, path, payload, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (job_key) DO NOTHING",
+                rows,
+            )
+            added = conn.total_changes - before
+        if added:
+            logger.info(f"📥 Queued {added} new job(s) for {variable}")
+        return added
+
+    def claim(self, variable: str, owner: str, limit: int = 1) -> List[Dict[str, Any]]:
+        """Lease up to `limit` due jobs of `variable`, oldest first."""
+        now = time.time()
+        with self._transaction() as conn:
+            # Jobs of dead workers that already used up their attempts
+            conn.execute(
+                "UPDATE jobs SET state = 'dead', last_error = 'lease expired', lease_owner = NULL, updated_at = ? "
+                "WHERE variable = ? AND state = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, variable, now, self.max_attempts),
+            )
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE variable = ? AND "
+                "((state = 'queued' AND available_at <= ?) OR (state = 'running' AND lease_expires < ?)) "
+                "ORDER BY id LIMIT ?",
+                (variable, now, now, limit),
+            ).fetchall()
+            ids = [row["id"] for row in rows]
+            if not ids:
+                return []
+            marks = ",".join("?" * len(ids))
+            conn.execute(
+                f"UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, "
+                f"lease_expires = ?, updated_at = ? WHERE id IN ({marks})",
+                (owner, now + self.lease_seconds, now, *ids),
+            )
+            jobs = conn.execute(f"SELECT * FROM jobs WHERE id IN ({marks}) ORDER BY id", ids).fetchall()
+        return [dict(job) for job in jobs]
+
+    def complete(self, job_id: int, owner: str) -> bool:
+        """Mark a job done; False if its lease was lost to another worker."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'done', lease_owner = NULL, lease_expires = NULL, last_error = NULL, "
+                "updated_at = ? WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (time.time(), job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def extend(self, job_ids: List[int], owner: str) -> int:
+        """Renew the leases `owner` still holds on `job_ids`; returns how many were renewed."""
+        if not job_ids:
+            return 0
+        now = time.time()
+        marks = ",".join("?" * len(job_ids))
+        with self._transaction() as conn:
+            return conn.execute(
+                f"UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                f"WHERE id IN ({marks}) AND lease_owner = ? AND state = 'running'",
+                (now + self.lease_seconds, now, *job_ids, owner),
+            ).rowcount
+
+    @contextmanager
+    def hold(self, job_ids: List[int], owner: str):
+        """Keep renewing the leases on `job_ids` while the block runs.
+
+        Claimed jobs can wait behind the rest of their batch or convert
+        for longer than one lease; without renewal another worker would
+        claim and convert them again.
+        """
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    self.extend(job_ids, owner)
+                except sqlite3.Error as e:
+                    logger.warning(f"⚠️ Could not renew job leases: {e}")
+
+        thread = threading.Thread(target=heartbeat, name="job-lease-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def fail(self, job_id: int, owner: str, error: str) -> Optional[str]:
+        """Record a failed attempt; returns the job's new state ("queued" or "dead")."""
+        now = time.time()
+        with self._transaction() as conn:
+            job = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                               (job_id, owner)).fetchone()
+            if job is None:
+                return None
+            state = "dead" if job["attempts"] >= self.max_attempts else "queued"
+            delay = self.retry_seconds * 2 ** (job["attempts"] - 1)
+            conn.execute(
+                "UPDATE jobs SET state = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL, "
+                "last_error = ?, updated_at = ? WHERE id = ?",
+                (state, now + delay, str(error)[:2000], now, job_id),
+            )
+        if state == "dead":
+            logger.error(f"💀 Job {job_id} failed {job['attempts']} times, moved to dead letters: {error}")
+        return state
+
+    def retry_dead(self, variable: Optional[str] = None) -> int:
+        """Requeue dead-lettered jobs with a fresh attempt budget."""
+        now = time.time()
+        query = "UPDATE jobs SET state = 'queued', attempts = 0, available_at = ?, updated_at = ? WHERE state = 'dead'"
+        params = [now, now]
+        if variable:
+            query += " AND variable = ?"
+            params.append(variable)
+        with self._transaction() as conn:
+            return conn.execute(query, params).rowcount
+
+    def prune(self, older_than_seconds: float = JOB_KEEP_SECONDS) -> int:
+        """Delete done jobs last updated more than `older_than_seconds` ago.
+
+        Jobs of files that still exist unchanged are kept: their row is what
+        makes enqueueing the file again a no-op.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT id, job_key, variable, path FROM jobs WHERE state = 'done' AND updated_at < ?",
+                                (time.time() - older_than_seconds,)).fetchall()
+            stale = []
+            for row in rows:
+                try:
+                    if job_key(row["variable"], row["path"]) == row["job_key"]:
+                        continue
+                except FileNotFoundError:
+                    pass
+                stale.append((row["id"],))
+            conn.executemany("DELETE FROM jobs WHERE id = ?", stale)
+        return len(stale)
+
+    def maybe_prune(self) -> None:
+        """`prune()` at most once per PRUNE_INTERVAL_SECONDS; called by idle workers."""
+        now = time.monotonic()
+        if now >= self.next_prune:
+            self.next_prune = now + PRUNE_INTERVAL_SECONDS
+            self.prune()
+
+    def status(self, dead_limit: int = 20) -> Dict[str, Any]:
+        """Job counts per variable and state, queue age, active workers and recent dead letters."""
+        now = time.time()
+        with self._connect() as conn:
+            counts = {}
+            for row in conn.execute("SELECT variable, state, COUNT(*) AS n FROM jobs GROUP BY variable, state"):
+                counts.setdefault(row["variable"], {})[row["state"]] = row["n"]
+            oldest = conn.execute("SELECT MIN(available_at) FROM jobs WHERE state = 'queued' AND available_at <= ?",
+                                  (now,)).fetchone()[0]
+            workers = [row[0] for row in conn.execute(
+                "SELECT DISTINCT lease_owner FROM jobs WHERE state = 'running' AND lease_expires >= ?", (now,))]
+            dead = [dict(row) for row in conn.execute(
+                "SELECT id, variable, path, attempts, last_error, updated_at FROM jobs WHERE state = 'dead' "
+                "ORDER BY updated_at DESC LIMIT ?", (dead_limit,))]
+        return {
+            "counts": counts,
+            "oldest_queued_seconds": now - oldest if oldest is not None else None,
+            "workers": workers,
+            "dead": dead,
+        }
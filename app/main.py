@@ -1,13 +1,20 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import Depends, FastAPI, Query, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from sqlalchemy import select
-from datetime import date
-from db import SessionLocal, MapRecord, Base, engine
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, text
+import json
+from datetime import date, datetime, timedelta
+from typing import Optional
+from db import get_session, init_db, pool_metrics
 from utils import build_spatiotemporal_query
-import tempfile
-import zipfile
+from catalog import DATETIME_FORMAT, TimestampCatalog, parse_since
+from cogindex import CogIndex
+from jobqueue import JobQueue
+from download import stream_clipped_zip, stream_cube
+from timeseries import query_area, query_point, to_response
 import os
+import sqlite3
 import logging
 
 # Configure logging
@@ -15,11 +22,14 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
+timestamp_catalog = TimestampCatalog()
+cog_index = CogIndex()
 
 # Try to create database tables, but don't fail if database is unavailable
+spatial_backend = "none"
 try:
-    Base.metadata.create_all(bind=engine)
-    logger.info("✅ Database tables created successfully")
+    spatial_backend = init_db()
+    logger.info(f"✅ Database tables created successfully (spatial index: {spatial_backend})")
 except Exception as e:
     logger.error(f"❌ Database connection failed: {e}")
     logger.info("⚠️ Starting without database connection - some endpoints will not work")
@@ -33,33 +43,97 @@ app.add_middleware(
 # allow_credentials=True,
 
 @app.get("/health")
-def health_check():
+async def health_check(db: AsyncSession = Depends(get_session)):
     """Health check endpoint to verify database connectivity"""
     try:
-        db = SessionLocal()
         # Test database connection
-        db.execute(select(1))
-        db.close()
+        await db.execute(select(1))
         return {"status": "healthy", "database": "connected"}
     except Exception as e:
         return {"status": "degraded", "database": "disconnected", "error": str(e)}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Connection pool utilization in Prometheus text format"""
+    return pool_metrics()
+
+@app.get("/queue/status")
+def queue_status():
+    """Conversion job counts per variable and state, active workers and dead letters"""
+    try:
+        return JobQueue().status()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=503, detail=f"Job queue unavailable: {e}")
+
 @app.get("/download")
-def download_data(start_date: date, end_date: date,
-                  xmin: float, ymin: float, xmax: float, ymax: float):
-    db = SessionLocal()
-    sql = build_spatiotemporal_query(start_date, end_date, (xmin, ymin, xmax, ymax))
-    result = db.execute(sql, {
-        "start": start_date, "end": end_date,
-        "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax
+async def download_data(start_date: date, end_date: date,
+                        xmin: float, ymin: float, xmax: float, ymax: float,
+                        variable: Optional[str] = None,
+                        format: str = Query("zip", pattern="^(zip|netcdf|zarr)$"),
+                        db: AsyncSession = Depends(get_session)):
+    if format in ("netcdf", "zarr"):
+        # A cube holds one variable; frames of several would share time steps
+        variable = variable or os.getenv('VARIABLE')
+        if not variable:
+            raise HTTPException(status_code=400, detail="variable is required for netcdf and zarr downloads")
+    sql = build_spatiotemporal_query(start_date, end_date, (xmin, ymin, xmax, ymax),
+                                     variable=variable, spatial_backend=spatial_backend)
+    result = await db.execute(text(sql), {
+        "start": start_date, "end": end_date + timedelta(days=1),
+        "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax,
+        "variable": variable
     })
-    files = [r['filepath'] for r in result]
+    rows = result.mappings().all()
+
+    bbox = (xmin, ymin, xmax, ymax)
+    if format in ("netcdf", "zarr"):
+        # One chunked (time, y, x) cube instead of one GeoTIFF per frame
+        records = [(r['acquisition_datetime'], r['filepath']) for r in rows]
+        extension = "nc" if format == "netcdf" else "zarr.zip"
+        return StreamingResponse(
+            stream_cube(records, bbox, variable, format),
+            media_type="application/x-netcdf" if format == "netcdf" else "application/zip",
+            headers={"Content-Disposition": f'attachment; filename="download.{extension}"'}
+        )
+
+    files = [r['filepath'] for r in rows]
+    # Each file is cropped to the bbox and streamed into the ZIP as soon as it is read
+    return StreamingResponse(
+        stream_clipped_zip(files, bbox),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="download.zip"'}
+    )
 
-    temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
-    with zipfile.ZipFile(temp_zip.name, 'w') as z:
-        for f in files:
-            z.write(f, os.path.basename(f))
-    return FileResponse(temp_zip.name, filename="download.zip")
+@app.get("/timeseries")
+def get_timeseries(variable: Optional[str] = None,
+                   lat: Optional[float] = None, lon: Optional[float] = None,
+                   xmin: Optional[float] = None, ymin: Optional[float] = None,
+                   xmax: Optional[float] = None, ymax: Optional[float] = None,
+                   geometry: Optional[str] = None,
+                   start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Value history of a point (lat/lon), or the mean over a small bbox or GeoJSON polygon"""
+    variable = variable or os.getenv('VARIABLE')
+    if not variable:
+        raise HTTPException(status_code=400, detail="variable is required")
+    bbox = (xmin, ymin, xmax, ymax)
+
+    try:
+        if lat is not None and lon is not None:
+            series = query_point(variable, lon, lat, start=start, end=end)
+        elif geometry is not None:
+            geojson = json.loads(geometry)
+            # Accept a Feature as well as a bare geometry
+            series = query_area(variable, geometry=geojson.get("geometry", geojson), start=start, end=end)
+        elif None not in bbox:
+            series = query_area(variable, bbox=bbox, start=start, end=end)
+        else:
+            raise HTTPException(status_code=400, detail="Provide lat/lon, xmin/ymin/xmax/ymax or geometry")
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if series is None:
+        raise HTTPException(status_code=404, detail="No time series for this variable and location")
+    return to_response(variable, series, DATETIME_FORMAT)
 
 # @app.get("/timestamps")
 # def list_timestamps():
@@ -69,60 +143,45 @@ def download_data(start_date: date, end_date: date,
 
 
 @app.get("/timestamps")
-def get_timestamps():
-    """Get available timestamps with value ranges"""
-    datetime_format = os.getenv('DATETIME_FORMAT', '%Y%m%dT%H%M%S')
-    
+async def get_timestamps(request: Request, variable: Optional[str] = None,
+                         since: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                         db: AsyncSession = Depends(get_session)):
+    """Get available timestamps with value ranges, oldest first.
+
+    `since` (exclusive) and `limit` page through the list; the next page
+    starts after the X-Next-Since header. Responses carry an ETag tied to
+    the catalog version, so unchanged lists are answered with 304.
+    """
     try:
-        db = SessionLocal()
-        # Fetch datetime, vmin, and vmax
-        results = db.execute(
-            select(
-                MapRecord.acquisition_datetime,
-                MapRecord.vmin,
-                MapRecord.vmax
-            )
-        ).fetchall()
-        
-        # Return list of dicts with all needed information
-        timestamps = sorted([{
-            'datetime': r[0].strftime(datetime_format),
-            'vmin': r[1],
-            'vmax': r[2]
-        } for r in results], key=lambda x: x['datetime'])
-        
-        db.close()
-        logger.info(f"✅ Returned {len(timestamps)} timestamps from database")
-        return timestamps
-        
+        since_datetime = parse_since(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid since: {since}")
+
+    try:
+        page = await timestamp_catalog.page(db, variable=variable, since=since_datetime, limit=limit)
+
+        headers = {"ETag": page["etag"], "Cache-Control": "no-cache"}
+        if page["next"]:
+            headers["X-Next-Since"] = page["next"]
+        if request.headers.get("if-none-match") == page["etag"]:
+            return Response(status_code=304, headers=headers)
+        logger.info(f"✅ Returned {page['count']} timestamps from database")
+        return Response(content=page["body"], media_type="application/json", headers=headers)
+
     except Exception as e:
         logger.error(f"❌ Failed to get timestamps from database: {e}")
         
-        # Fallback: read from filesystem
+        # Fallback: COG index maintained by ingest, reloaded only when it changes
         try:
-            import glob
-            import re
-            
-            cog_path = "/app/data/cogs"
-            cog_files = glob.glob(f"{cog_path}/*.tif")
-            
-            timestamps = []
-            for file_path in cog_files:
-                filename = os.path.basename(file_path)
-                # Extract datetime from filename: SISGHI-No-Horizon_20240103T102743.tif
-                match = re.search(r'(\d{8}T\d{6})', filename)
-                if match:
-                    datetime_str = match.group(1)
-                    timestamps.append({
-                        'datetime': datetime_str,
-                        'vmin': 0,  # Default values since we can't read from TIFF metadata easily
-                        'vmax': 1000
-                    })
-            
-            timestamps = sorted(timestamps, key=lambda x: x['datetime'])
-            logger.info(f"✅ Returned {len(timestamps)} timestamps from filesystem")
+            timestamps = cog_index.timestamps(variable)
+            if since_datetime is not None:
+                since_key = since_datetime.strftime(DATETIME_FORMAT)
+                timestamps = [t for t in timestamps if t['datetime'] > since_key]
+            if limit is not None:
+                timestamps = timestamps[:limit]
+            logger.info(f"✅ Returned {len(timestamps)} timestamps from the COG index")
             return timestamps
-            
+
         except Exception as fs_error:
             logger.error(f"❌ Filesystem fallback also failed: {fs_error}")
             return []
\ No newline at end of file
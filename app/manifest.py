@@ -0,0 +1,135 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def options_digest(options: Dict[str, Any]) -> str:
+    """Return a stable digest of the conversion options (variable, COG options, ...)."""
+    payload = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class IngestManifest:
+    """Persistent record of NetCDF files that have already been ingested.
+
+    Entries are keyed on the absolute source path and store size, mtime,
+    content hash and a digest of the conversion options. A file whose
+    stat() still matches its entry is skipped without being opened; the
+    content hash is only computed when size or mtime changed.
+
+    The watcher and queue workers share one manifest file: `save()` merges
+    this process's changes into the file under a lock, and `refresh()`
+    picks up entries other processes saved.
+    """
+
+    def __init__(self, manifest_path: str, options: Dict[str, Any]):
+        self.manifest_path = manifest_path
+        self.options_key = options_digest(options)
+        self._loaded_mtime = None
+        self.entries = self._load()
+        self._changed = set()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            self._loaded_mtime = os.stat(self.manifest_path).st_mtime_ns
+            with open(self.manifest_path, "r") as f:
+                return json.load(f).get("files", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Could not read ingest manifest {self.manifest_path}: {e}")
+            return {}
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock on the manifest file, held across processes and containers on one host."""
+        directory = os.path.dirname(self.manifest_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{self.manifest_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _merged(self) -> Dict[str, Dict[str, Any]]:
+        """Entries on disk with this process's unsaved changes on top."""
+        entries = self._load()
+        entries.update((path, self.entries[path]) for path in self._changed)
+        return entries
+
+    def refresh(self) -> None:
+        """Reload the entries if another process saved the manifest since it was read."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._loaded_mtime:
+            self.entries = self._merged()
+
+    def save(self) -> None:
+        """Atomically write the manifest if it changed, keeping entries saved by other processes."""
+        if not self._changed:
+            return
+        with self._lock():
+            entries = self._merged()
+            tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump({"updated": datetime.now().isoformat(), "files": entries}, f)
+            os.replace(tmp_path, self.manifest_path)
+            self._loaded_mtime = os.stat(self.manifest_path).st_mtime_ns
+        self.entries = entries
+        self._changed.clear()
+
+    def is_current(self, path: str, st: Optional[os.stat_result] = None) -> bool:
+        """Return True if `path` was already ingested with the current options."""
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
+        if entry is None or entry.get("options") != self.options_key:
+            return False
+
+        st = st or os.stat(path)
+        if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            return True
+
+        # Stat changed (touched, copied over, ...): fall back to the content hash
+        if entry["size"] != st.st_size:
+            return False
+        if file_digest(path) != entry["sha256"]:
+            return False
+
+        entry["mtime"] = st.st_mtime_ns
+        self._changed.add(path)
+        return True
+
+    def record(self, path: str, **extra: Any) -> None:
+        """Record `path` as ingested with the current options."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        self.entries[path] = {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "sha256": file_digest(path),
+            "options": self.options_key,
+            "ingested_at": datetime.now().isoformat(),
+            **extra,
+        }
+        self._changed.add(path)
@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+# Prometheus textfile (node_exporter textfile collector format) rewritten after every ingest run,
+# plus one JSON line per run for offline analysis of past runs
+METRICS_FILE = os.getenv("METRICS_FILE", "data/metrics/ingest.prom")
+METRICS_HISTORY = os.getenv("METRICS_HISTORY", "data/metrics/ingest_runs.jsonl")
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF) -> int:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageMetrics:
+    """Accumulated time per pipeline stage plus named counters for one process.
+
+    Worker processes return `delta()` snapshots that the parent `merge()`s,
+    so the parent ends up with totals over every process of a run.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Start a new run; the ingest daemon calls this before every cycle."""
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(float)
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+
+    def add(self, counter: str, value: float = 1) -> None:
+        self.counters[counter] += value
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def delta(self, since: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+        """What was recorded after `since` (an earlier snapshot)."""
+        now = self.snapshot()
+        return {
+            kind: {key: value - since[kind].get(key, 0) for key, value in values.items()
+                   if value != since[kind].get(key, 0)}
+            for kind, values in now.items()
+        }
+
+    def merge(self, other: Dict[str, Dict[str, float]]) -> None:
+        for key, value in other.get("seconds", {}).items():
+            self.seconds[key] += value
+        for key, value in other.get("calls", {}).items():
+            self.calls[key] += value
+        for key, value in other.get("counters", {}).items():
+            self.counters[key] += value
+
+    def render(self, prefix: str = "ingest", gauges: Optional[Dict[str, float]] = None) -> str:
+        """Prometheus text exposition of the stages, counters and extra gauges."""
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent in each stage during the last run",
+            f"# TYPE {prefix}_stage_seconds gauge",
+        ]
+        lines += [f'{prefix}_stage_seconds{{stage="{stage}"}} {value:.6f}'
+                  for stage, value in sorted(self.seconds.items())]
+        lines += [
+            f"# HELP {prefix}_stage_calls Number of times each stage ran during the last run",
+            f"# TYPE {prefix}_stage_calls gauge",
+        ]
+        lines += [f'{prefix}_stage_calls{{stage="{stage}"}} {value}'
+                  for stage, value in sorted(self.calls.items())]
+        for name, value in sorted({**self.counters, **(gauges or {})}.items()):
+            lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, gauges: Optional[Dict[str, float]] = None, path: Optional[str] = None,
+              history_path: Optional[str] = None) -> None:
+        """Atomically replace the textfile and append the run to the JSON-lines history."""
+        path = path or METRICS_FILE
+        history_path = history_path or METRICS_HISTORY
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(self.render(gauges=gauges))
+        os.replace(tmp_path, path)
+
+        os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+        with open(history_path, "a") as f:
+            f.write(json.dumps({**self.snapshot(), "gauges": gauges or {}}) + "\n")
+
+
+# Process-wide collector used by convert.py and ingest.py
+metrics = StageMetrics()
@@ -24,8 +24,8 @@ except Exception as e:
 echo "📋 Creating database tables..."
 python -c "
 try:
-    from db import Base, engine
-    Base.metadata.create_all(bind=engine)
+    from db import init_db
+    init_db()
     print('✅ Database tables created')
 except Exception as e:
     print(f'⚠️ Could not create tables: {e}')
@@ -0,0 +1,100 @@
+import os
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+
+try:
+    import morecantile
+    from rio_tiler.colormap import cmap
+    from rio_tiler.errors import TileOutsideBounds
+    from rio_tiler.io import Reader
+except ImportError:
+    Reader = None
+
+logger = logging.getLogger(__name__)
+
+# Pre-rendered tile cache, served by nginx under /tiles/{cog_stem}/{colormap}/{z}/{x}/{y}.{format}
+PRERENDER_TILES = os.getenv("PRERENDER_TILES", "false").lower() in ("1", "true", "yes")
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "data/tiles")
+TILE_ZOOMS = os.getenv("TILE_ZOOMS", "5-9")
+TILE_COLORMAPS = os.getenv("TILE_COLORMAPS", "magma")
+TILE_FORMAT = os.getenv("TILE_FORMAT", "png").lower()
+# Swiss domain (west, south, east, north) in EPSG:4326
+TILE_BOUNDS = os.getenv("TILE_BOUNDS", "5.9,45.8,10.5,47.9")
+
+IMAGE_FORMATS = {"png": "PNG", "webp": "WEBP"}
+
+
+def parse_zooms(zooms: str) -> List[int]:
+    """Parse "5-9" or "5,6,8" into a list of zoom levels."""
+    levels = []
+    for part in zooms.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            levels.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            levels.append(int(part))
+    return sorted(set(levels))
+
+
+def iter_tiles(bounds: Tuple[float, float, float, float], zooms: Iterable[int]):
+    """Yield the WebMercatorQuad tiles covering `bounds` at each zoom level."""
+    tms = morecantile.tms.get("WebMercatorQuad")
+    yield from tms.tiles(*bounds, zooms=list(zooms))
+
+
+def tile_path(cache_dir: Path, cog_path: Path, colormap: str, z: int, x: int, y: int, tile_format: str) -> Path:
+    return cache_dir / Path(cog_path).stem / colormap / str(z) / str(x) / f"{y}.{tile_format}"
+
+
+def render_tile_pyramid(
+    cog_path: Union[str, Path],
+    vmin: float,
+    vmax: float,
+    colormaps: Optional[List[str]] = None,
+    zooms: Optional[List[int]] = None,
+    bounds: Optional[Tuple[float, float, float, float]] = None,
+    tile_format: Optional[str] = None,
+    cache_dir: Union[str, Path, None] = None) -> int:
+    """Render the tiles the frontend requests for one COG and store them on disk.
+
+    Tiles are rendered with rio-tiler, the library TiTiler uses, with the
+    same unscale/rescale/colormap parameters as the frontend's dynamic tile
+    URL, so a cached tile and a TiTiler fallback tile are identical.
+    Returns the number of tiles written.
+    """
+    if Reader is None:
+        raise ImportError("rio-tiler is required to pre-render tiles")
+
+    colormaps = colormaps or [c.strip() for c in TILE_COLORMAPS.split(",") if c.strip()]
+    zooms = zooms or parse_zooms(TILE_ZOOMS)
+    bounds = bounds or tuple(float(v) for v in TILE_BOUNDS.split(","))
+    tile_format = (tile_format or TILE_FORMAT).lower()
+    cache_dir = Path(cache_dir or TILE_CACHE_DIR)
+    if tile_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported tile format '{tile_format}', expected one of {sorted(IMAGE_FORMATS)}")
+
+    colormap_data = {name: cmap.get(name) for name in colormaps}
+    written = 0
+    with Reader(str(cog_path)) as src:
+        for tile in iter_tiles(bounds, zooms):
+            if not src.tile_exists(tile.x, tile.y, tile.z):
+                continue
+            try:
+                image = src.tile(tile.x, tile.y, tile.z, unscale=True)
+            except TileOutsideBounds:
+                continue
+            image.rescale(in_range=((vmin, vmax),))
+
+            for name, colormap in colormap_data.items():
+                content = image.render(img_format=IMAGE_FORMATS[tile_format], colormap=colormap)
+                path = tile_path(cache_dir, cog_path, name, tile.z, tile.x, tile.y, tile_format)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Write then rename so nginx never serves a partial tile
+                tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+                tmp_path.write_bytes(content)
+                os.replace(tmp_path, path)
+                written += 1
+
+    logger.info(f"Pre-rendered {written} tiles for {Path(cog_path).name} (zooms {zooms[0]}-{zooms[-1]}, {colormaps})")
+    return written
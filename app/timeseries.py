@@ -0,0 +1,250 @@
+import os
+import fcntl
+import logging
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.errors import WindowError
+from rasterio.features import bounds as geometry_bounds, geometry_mask
+from rasterio.transform import Affine, rowcol
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform as transform_coords, transform_bounds, transform_geom
+from rasterio.windows import Window, from_bounds
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+logger = logging.getLogger(__name__)
+
+# Time-major pixel store: one group per variable holding values (time, y, x) and time (epoch s).
+# Chunks are long along time and small in space, so a pixel history is a handful of chunk reads.
+TIMESERIES_ENABLED = os.getenv("TIMESERIES_ENABLED", "true").lower() in ("1", "true", "yes")
+TIMESERIES_STORE = os.getenv("TIMESERIES_STORE", "data/timeseries.zarr")
+# Defaults: one week of 15-minute frames by 8x8 pixels (~170 KiB per chunk), so a year of one
+# pixel is ~50 chunk reads. Only affects newly created variables.
+TIMESERIES_TIME_CHUNK = int(os.getenv("TIMESERIES_TIME_CHUNK", "672"))
+TIMESERIES_SPATIAL_CHUNK = int(os.getenv("TIMESERIES_SPATIAL_CHUNK", "8"))
+# Largest bbox/polygon query, in pixels
+TIMESERIES_MAX_PIXELS = int(os.getenv("TIMESERIES_MAX_PIXELS", "4096"))
+
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("zarr is required for the time-series store")
+
+
+def open_variable(variable: str, mode: str = "r", store: Optional[str] = None):
+    """Open the group of one variable, or None if it does not exist yet."""
+    _require_zarr()
+    path = os.path.join(store or TIMESERIES_STORE, variable)
+    if mode == "r" and not os.path.exists(path):
+        return None
+    return zarr.open_group(path, mode=mode)
+
+
+def _grid_of(group) -> Dict[str, Any]:
+    attrs = group.attrs
+    return {
+        "crs": CRS.from_wkt(attrs["crs"]),
+        "transform": Affine(*attrs["transform"]),
+        "height": attrs["height"],
+        "width": attrs["width"],
+    }
+
+
+def _read_onto_grid(path: str, grid: Dict[str, Any]) -> np.ndarray:
+    """Read a COG as physical float32 values on the store grid, NaN for NoData."""
+    with rasterio.open(path) as src:
+        scale, offset = src.scales[0], src.offsets[0]
+        same_grid = (src.crs == grid["crs"] and src.transform == grid["transform"]
+                     and src.shape == (grid["height"], grid["width"]))
+        if same_grid:
+            data = src.read(1, masked=True)
+        else:
+            with WarpedVRT(src, crs=grid["crs"], transform=grid["transform"],
+                           width=grid["width"], height=grid["height"]) as vrt:
+                data = vrt.read(1, masked=True)
+        return (data.astype(np.float32) * scale + offset).filled(np.nan)
+
+
+def _create_variable(variable: str, first_cog: str, store: Optional[str] = None):
+    with rasterio.open(first_cog) as src:
+        grid = {
+            "crs": src.crs.to_wkt(),
+            "transform": list(src.transform)[:6],
+            "height": src.height,
+            "width": src.width,
+        }
+    group = zarr.open_group(os.path.join(store or TIMESERIES_STORE, variable), mode="a")
+    group.attrs.update(grid)
+    spatial = TIMESERIES_SPATIAL_CHUNK
+    # zarr 3 renamed create_dataset to create_array; zarr 2 (the last release for Python 3.10) only has the former
+    create = getattr(group, "create_array", None) or group.create_dataset
+    create(
+        "values", shape=(0, grid["height"], grid["width"]), dtype="float32",
+        chunks=(TIMESERIES_TIME_CHUNK, spatial, spatial), fill_value=np.nan,
+    )
+    create("time", shape=(0,), dtype="int64", chunks=(TIMESERIES_TIME_CHUNK * 64,), fill_value=0)
+    return group
+
+
+@contextmanager
+def _append_lock(variable: str, store: Optional[str] = None):
+    """Exclusive lock on a variable's arrays, held across processes and containers on one host."""
+    store = store or TIMESERIES_STORE
+    os.makedirs(store, exist_ok=True)
+    with open(os.path.join(store, f".{variable}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def append_frames(variable: str, frames: Sequence[Tuple[datetime, str]], store: Optional[str] = None) -> int:
+    """Append COG frames (acquisition datetime, path) to the variable's time-major store.
+
+    Frames whose datetime is already stored overwrite that row, so a
+    reprocessed frame replaces its old values. Callers should append in
+    batches: each call rewrites the partially filled trailing time chunk
+    of every spatial tile once.
+    """
+    _require_zarr()
+    if not frames:
+        return 0
+    # Watcher and queue workers append concurrently; unserialized appends leave
+    # the time and values arrays with different lengths
+    with _append_lock(variable, store):
+        return _append_frames(variable, frames, store)
+
+
+def _append_frames(variable: str, frames: Sequence[Tuple[datetime, str]], store: Optional[str] = None) -> int:
+    group = open_variable(variable, mode="a", store=store)
+    if "values" not in group:
+        group = _create_variable(variable, frames[0][1], store)
+    grid = _grid_of(group)
+    values_array = group["values"]
+    time_array = group["time"]
+
+    rows = {epoch: index for index, epoch in enumerate(time_array[:].tolist())}
+    # Last version of each frame in the batch
+    latest = {}
+    for acquisition_datetime, cog_path in frames:
+        latest[int(np.datetime64(acquisition_datetime, "s").astype(np.int64))] = cog_path
+
+    new_times = []
+    new_values = []
+    replaced = 0
+    for epoch, cog_path in latest.items():
+        values = _read_onto_grid(cog_path, grid)
+        if epoch in rows:
+            values_array[rows[epoch]] = values
+            replaced += 1
+        else:
+            new_values.append(values)
+            new_times.append(epoch)
+
+    if new_times:
+        # Values first: readers only look at the first len(time) rows
+        values_array.append(np.stack(new_values), axis=0)
+        time_array.append(np.array(new_times, dtype=np.int64), axis=0)
+    logger.info(f"✅ Appended {len(new_times)} and replaced {replaced} frames in time-series store for {variable}")
+    return len(new_times) + replaced
+
+
+def _time_selection(times: np.ndarray, start: Optional[datetime], end: Optional[datetime]) -> Tuple[slice, np.ndarray]:
+    """Rows to read for [start, end] and, within them, the selected rows ordered by time.
+
+    Reading only from the first to the last selected row keeps a short
+    query from loading the whole history.
+    """
+    mask = np.ones(times.shape, dtype=bool)
+    if start is not None:
+        mask &= times >= np.datetime64(start, "s").astype(np.int64)
+    if end is not None:
+        mask &= times <= np.datetime64(end, "s").astype(np.int64)
+    indices = np.nonzero(mask)[0]
+    if not len(indices):
+        return slice(0, 0), indices
+    rows = slice(int(indices[0]), int(indices[-1]) + 1)
+    return rows, indices[np.argsort(times[indices], kind="stable")] - rows.start
+
+
+def query_point(variable: str, lon: float, lat: float,
+                start: Optional[datetime] = None, end: Optional[datetime] = None,
+                store: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Value history of the pixel containing (lon, lat). None if there is no store or no such pixel."""
+    group = open_variable(variable, store=store)
+    if group is None:
+        return None
+    grid = _grid_of(group)
+    xs, ys = transform_coords("EPSG:4326", grid["crs"], [lon], [lat])
+    row, col = rowcol(grid["transform"], xs[0], ys[0])
+    if not (0 <= row < grid["height"] and 0 <= col < grid["width"]):
+        return None
+
+    times = group["time"][:]
+    rows, order = _time_selection(times, start, end)
+    column = group["values"][rows, row, col]
+    return {"time": times[rows][order], "values": column[order]}
+
+
+def query_area(variable: str, bbox: Optional[Tuple[float, float, float, float]] = None,
+               geometry: Optional[Dict[str, Any]] = None,
+               start: Optional[datetime] = None, end: Optional[datetime] = None,
+               store: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Mean history over a small EPSG:4326 bbox or GeoJSON polygon (bbox of the polygon + mask)."""
+    group = open_variable(variable, store=store)
+    if group is None:
+        return None
+    grid = _grid_of(group)
+
+    if geometry is not None:
+        bbox = geometry_bounds(geometry)
+        if grid["crs"].to_epsg() != 4326:
+            geometry = transform_geom("EPSG:4326", grid["crs"], geometry)
+
+    bounds = transform_bounds("EPSG:4326", grid["crs"], *bbox)
+    try:
+        window = from_bounds(*bounds, transform=grid["transform"])
+        window = window.intersection(Window(0, 0, grid["width"], grid["height"]))
+    except WindowError:
+        return None
+    window = window.round_offsets().round_lengths()
+    height, width = int(window.height), int(window.width)
+    if height < 1 or width < 1:
+        return None
+    if height * width > TIMESERIES_MAX_PIXELS:
+        raise ValueError(f"Area covers {height * width} pixels, limit is {TIMESERIES_MAX_PIXELS}")
+
+    row0, col0 = int(window.row_off), int(window.col_off)
+    times = group["time"][:]
+    rows, order = _time_selection(times, start, end)
+    times = times[rows]
+    block = group["values"][rows, row0:row0 + height, col0:col0 + width]
+    if geometry is not None:
+        outside = geometry_mask([geometry], out_shape=(height, width),
+                                transform=rasterio.windows.transform(window, grid["transform"]))
+        block[:, outside] = np.nan
+
+    with warnings.catch_warnings():
+        # All-NaN steps (no valid pixel in the area) give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        means = np.nanmean(block.reshape(len(times), -1), axis=1)
+    return {"time": times[order], "values": means[order]}
+
+
+def to_response(variable: str, series: Dict[str, Any], datetime_format: str) -> Dict[str, List]:
+    datetimes = np.array(series["time"], dtype="datetime64[s]").astype(datetime)
+    return {
+        "variable": variable,
+        "datetimes": [d.strftime(datetime_format) for d in datetimes],
+        "values": [None if np.isnan(v) else float(v) for v in series["values"]],
+    }
@@ -1,12 +1,27 @@
-def build_spatiotemporal_query(start_date, end_date, bbox):
+def build_spatiotemporal_query(start_date, end_date, bbox, variable=None, spatial_backend="none"):
     """
-    Returns a SQL string to filter by date range.
-    Since we don't have spatial indexing yet, this just filters by time.
-    Expects bbox as (xmin, ymin, xmax, ymax) for future spatial filtering.
+    Returns a SQL string selecting maps whose footprint intersects the bbox within a time range.
+    Expects bbox as (xmin, ymin, xmax, ymax) in EPSG:4326, bound as :xmin, :ymin, :xmax, :ymax,
+    and the time range bound as :start (inclusive) and :end (exclusive).
+    The spatial predicate uses the index created by db.create_spatial_index for `spatial_backend`.
+    Records ingested before footprints were stored have no bounds and are always included.
     """
-    query = """
-    SELECT * FROM maps
-    WHERE acquisition_datetime BETWEEN :start AND :end
+    if spatial_backend == "postgis":
+        intersects = "ST_Intersects(footprint, ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326))"
+    elif spatial_backend == "box":
+        intersects = "box(point(xmin, ymin), point(xmax, ymax)) && box(point(:xmin, :ymin), point(:xmax, :ymax))"
+    else:
+        intersects = "xmin <= :xmax AND xmax >= :xmin AND ymin <= :ymax AND ymax >= :ymin"
+
+    filters = "acquisition_datetime >= :start AND acquisition_datetime < :end"
+    if variable is not None:
+        filters += " AND variable = :variable"
+    # Legacy rows in their own branch: OR-ing "xmin IS NULL" into the spatial
+    # predicate would keep the planner from using the spatial index
+    query = f"""
+    SELECT * FROM maps WHERE {filters} AND {intersects}
+    UNION ALL
+    SELECT * FROM maps WHERE {filters} AND xmin IS NULL
     ORDER BY acquisition_datetime
     """
     return query
@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import inotify_simple
+    HAS_INOTIFY = True
+except ImportError:
+    HAS_INOTIFY = False
+
+logger = logging.getLogger(__name__)
+
+# "auto" uses inotify when available, "poll" forces directory scans (e.g. for NFS or
+# Docker Desktop bind mounts, which do not deliver inotify events)
+INGEST_WATCH_MODE = os.getenv("INGEST_WATCH_MODE", "auto")
+# Seconds a file's size and mtime must stay unchanged before it is reported
+INGEST_SETTLE_SECONDS = float(os.getenv("INGEST_SETTLE_SECONDS", "10"))
+# Scan interval of the polling fallback
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "15"))
+# Interval at which every file is reported again, so failed conversions are retried
+# and events lost to an inotify queue overflow are caught up
+INGEST_RESCAN_SECONDS = float(os.getenv("INGEST_RESCAN_SECONDS", "600"))
+# Longest blocking wait, so a stop request is noticed quickly
+MAX_WAIT_SECONDS = 1.0
+
+Signature = Tuple[int, int]
+
+
+def file_signature(path: str) -> Optional[Signature]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def scan_directory(directory: str, suffix: str) -> Dict[str, Signature]:
+    signatures = {}
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix) and entry.is_file():
+            st = entry.stat()
+            signatures[entry.path] = (st.st_size, st.st_mtime_ns)
+    return signatures
+
+
+class DirectoryWatcher:
+    """Report files of a directory once they have stopped changing.
+
+    Changes come from inotify when inotify_simple is installed and the
+    filesystem supports it, otherwise from comparing directory scans. A
+    file is only reported after its size and mtime stayed the same for
+    `settle` seconds, so files that are still being copied or written are
+    not picked up half-written. Every file present is reported at start
+    and then every `rescan_interval` seconds; callers filter out what they
+    already processed.
+    """
+
+    def __init__(self, directory: str, suffix: str = ".nc", settle: float = INGEST_SETTLE_SECONDS,
+                 poll_interval: float = INGEST_POLL_SECONDS, rescan_interval: float = INGEST_RESCAN_SECONDS,
+                 mode: str = INGEST_WATCH_MODE):
+        self.directory = directory
+        self.suffix = suffix
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        # path -> (signature, monotonic time the signature was first seen)
+        self.pending: Dict[str, Tuple[Signature, float]] = {}
+        self.known: Dict[str, Signature] = {}
+        self.last_scan = 0.0
+        self.last_full_scan = 0.0
+        self.running = True
+        self.inotify = self._start_inotify() if mode != "poll" else None
+        logger.info(f"👀 Watching {directory} with {'inotify' if self.inotify else 'polling'}")
+
+    def _start_inotify(self):
+        if not HAS_INOTIFY:
+            logger.warning("⚠️ inotify_simple is not installed, falling back to polling")
+            return None
+        try:
+            inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            inotify.add_watch(self.directory, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO)
+            return inotify
+        except OSError as e:
+            logger.warning(f"⚠️ inotify unavailable for {self.directory} ({e}), falling back to polling")
+            return None
+
+    def stop(self) -> None:
+        """Make `batches()` return at its next wakeup; safe to call from a signal handler."""
+        self.running = False
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _touch(self, path: str, now: float) -> None:
+        signature = file_signature(path)
+        if signature is None:
+            self.pending.pop(path, None)
+            self.known.pop(path, None)
+            return
+        current = self.pending.get(path)
+        if current is None or current[0] != signature:
+            self.pending[path] = (signature, now)
+
+    def _scan(self, now: float, everything: bool = False) -> None:
+        signatures = scan_directory(self.directory, self.suffix)
+        for path, signature in signatures.items():
+            if everything or self.known.get(path) != signature:
+                self._touch(path, now)
+        self.known = signatures
+        self.last_scan = now
+        if everything:
+            self.last_full_scan = now
+
+    def _settled(self, now: float) -> List[str]:
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            if now - since < self.settle:
+                continue
+            current = file_signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)
+            else:
+                del self.pending[path]
+                self.known[path] = current
+                ready.append(path)
+        return sorted(ready)
+
+    def _wait(self, now: float) -> None:
+        if self.pending:
+            due = min(since for _, since in self.pending.values()) + self.settle
+        elif self.inotify is not None:
+            due = self.last_full_scan + self.rescan_interval
+        else:
+            due = self.last_scan + self.poll_interval
+        timeout = min(max(due - now, 0.05), MAX_WAIT_SECONDS)
+
+        if self.inotify is None:
+            time.sleep(timeout)
+            now = time.monotonic()
+            if now - self.last_full_scan >= self.rescan_interval:
+                self._scan(now, everything=True)
+            elif now - self.last_scan >= self.poll_interval:
+                self._scan(now)
+            return
+
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        now = time.monotonic()
+        if any(event.mask & inotify_simple.flags.Q_OVERFLOW for event in events):
+            logger.warning("⚠️ inotify queue overflowed, rescanning")
+            self._scan(now, everything=True)
+            return
+        for name in {event.name for event in events}:
+            if name.endswith(self.suffix):
+                self._touch(os.path.join(self.directory, name), now)
+        if now - self.last_full_scan >= self.rescan_interval:
+            self._scan(now, everything=True)
+
+    def batches(self, idle_every: Optional[float] = None) -> Iterator[List[str]]:
+        """Yield lists of settled paths until `stop()` is called.
+
+        With `idle_every`, an empty list is yielded when nothing was
+        reported for that many seconds, so the caller can do periodic work.
+        """
+        self._scan(time.monotonic(), everything=True)
+        last_yield = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            ready = self._settled(now)
+            if ready or (idle_every is not None and now - last_yield >= idle_every):
+                yield ready
+                last_yield = time.monotonic()
+                continue
+            self._wait(now)
@@ -0,0 +1,263 @@
+"""Benchmark of the NetCDF -> COG conversion pipeline on synthetic data.
+
+Generates NetCDF files shaped like data/netcdf/SISGHI-No-Horizon_*.nc
+(time, y, x float32 on the 0.05 deg domain) for every combination of grid
+scale, number of time steps and NaN ratio, then measures:
+
+- per-stage time: open, extract, prepare (includes stats), stats,
+  metadata, write, validate
+- end-to-end convert_netcdf_to_cogs time, files/s and frames/s
+- peak RSS of the process that ran the case
+
+Each case runs in a fresh process so peak RSS is per case. Results go to
+a JSON file; --compare prints the ratio to an earlier result file.
+
+    python benchmarks/bench_convert.py --output bench.json
+    python benchmarks/bench_convert.py --scales 1,2 --times 1,96 --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+sys.path.insert(0, str(APP_DIR))
+os.environ.setdefault("DATETIME_FORMAT", "%Y%m%dT%H%M%S")
+
+VARIABLE = "SISGHI-No-Horizon"
+# Grid of the operational files: 700 x 380 cells of 0.05 deg
+DOMAIN = (-8.0, 30.0, 27.0, 49.0)
+BASE_RESOLUTION = 0.05
+
+
+def make_netcdf(path, scale=1, time_steps=1, nan_ratio=0.0, seed=0):
+    """Write a synthetic irradiance cube; `scale` divides the cell size."""
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import rioxarray  # noqa: F401  (registers .rio)
+
+    rng = np.random.default_rng(seed)
+    resolution = BASE_RESOLUTION / scale
+    west, south, east, north = DOMAIN
+    x = np.arange(west + resolution / 2, east, resolution, dtype=np.float32)
+    y = np.arange(south + resolution / 2, north, resolution, dtype=np.float32)
+    times = pd.date_range("2024-06-01T10:00", periods=time_steps, freq="15min")
+
+    # Clear-sky-like field: diurnal cycle times a latitude gradient, plus cloud noise
+    lat_factor = np.cos(np.deg2rad(y - 20.0))[:, None]
+    lon_phase = np.deg2rad(x)[None, :]
+    data = np.empty((time_steps, len(y), len(x)), dtype=np.float32)
+    for i, t in enumerate(times):
+        hour_angle = (t.hour + t.minute / 60 - 12) / 24 * 2 * np.pi
+        elevation = np.clip(np.cos(hour_angle + lon_phase), 0, None)
+        clouds = rng.uniform(0.3, 1.0, size=(len(y), len(x))).astype(np.float32)
+        data[i] = 1000 * elevation * lat_factor * clouds
+        if nan_ratio > 0:
+            data[i][rng.random((len(y), len(x))) < nan_ratio] = np.nan
+
+    dataset = xr.Dataset(
+        {VARIABLE: (("time", "y", "x"), data)},
+        coords={"time": times, "y": y, "x": x},
+    )
+    dataset = dataset.rio.write_crs("EPSG:4326")
+    dataset.to_netcdf(path, encoding={VARIABLE: {"_FillValue": np.float32(np.nan)}})
+    return path
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def time_stages(netcdf_path, output_dir):
+    """Run the conversion stage by stage with the functions convert_data_array uses."""
+    import numpy as np
+    import convert
+
+    stages = dict.fromkeys(["open", "extract", "prepare", "stats", "metadata", "write", "validate"], 0.0)
+    chunks = {"time": 1} if convert.HAS_DASK else None
+
+    start = time.perf_counter()
+    dataset = convert.open_netcdf_dataset(netcdf_path, chunks=chunks)
+    stages["open"] += time.perf_counter() - start
+
+    frames = 0
+    bytes_written = 0
+    with dataset:
+        slices = convert.iter_time_slices(dataset, VARIABLE)
+        while True:
+            start = time.perf_counter()
+            try:
+                data_array, timestamp = next(slices)
+            except StopIteration:
+                break
+            data_array = data_array.load()
+            stages["extract"] += time.perf_counter() - start
+
+            # Measured on its own; prepare_data_array runs it again internally
+            values = np.asarray(data_array.values, dtype=np.float32).copy()
+            start = time.perf_counter()
+            convert.compute_statistics(values)
+            stages["stats"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            data_array, stats = convert.prepare_data_array(data_array)
+            stages["prepare"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            data_array, _ = convert.add_metadata(data_array, stats)
+            stages["metadata"] += time.perf_counter() - start
+
+            cog_path = Path(output_dir) / f"{VARIABLE}_{timestamp}.tif"
+            start = time.perf_counter()
+            stats.update(convert.write_cog(data_array, cog_path, convert.resolve_cog_options()))
+            stages["write"] += time.perf_counter() - start
+            bytes_written += cog_path.stat().st_size
+
+            start = time.perf_counter()
+            convert.validate_cog(cog_path)
+            stages["validate"] += time.perf_counter() - start
+            frames += 1
+    return stages, frames, bytes_written
+
+
+def run_case(case, work_dir, repeat):
+    """Generate the case's file and measure it. Runs in a child process."""
+    import logging
+    logging.disable(logging.INFO)
+    import convert
+
+    case_dir = Path(work_dir) / f"s{case['scale']}_t{case['time_steps']}_n{case['nan_ratio']}"
+    case_dir.mkdir(parents=True, exist_ok=True)
+    netcdf_path = case_dir / f"{VARIABLE}_bench.nc"
+    make_netcdf(netcdf_path, case["scale"], case["time_steps"], case["nan_ratio"])
+
+    stage_runs = []
+    end_to_end = []
+    for _ in range(repeat):
+        output_dir = case_dir / "cogs"
+        shutil.rmtree(output_dir, ignore_errors=True)
+        output_dir.mkdir()
+        stages, frames, bytes_written = time_stages(netcdf_path, output_dir)
+        stage_runs.append(stages)
+
+        shutil.rmtree(output_dir)
+        start = time.perf_counter()
+        convert.convert_netcdf_to_cogs(netcdf_path, VARIABLE, output_dir=output_dir)
+        end_to_end.append(time.perf_counter() - start)
+
+    # Best of `repeat` runs, the usual way to reduce scheduler noise
+    seconds = min(end_to_end)
+    with convert.open_netcdf_dataset(netcdf_path) as dataset:
+        height, width = dataset[VARIABLE].shape[-2:]
+    return {
+        **case,
+        "height": int(height),
+        "width": int(width),
+        "frames": frames,
+        "netcdf_mb": netcdf_path.stat().st_size / 1024 / 1024,
+        "cog_mb": bytes_written / 1024 / 1024,
+        "stages_seconds": {name: min(run[name] for run in stage_runs) for name in stage_runs[0]},
+        "end_to_end_seconds": seconds,
+        "files_per_second": 1 / seconds,
+        "frames_per_second": frames / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=APP_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print end-to-end and per-stage time ratios against a previous result file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = lambda c: (c["scale"], c["time_steps"], c["nan_ratio"])
+    previous = {key(c): c for c in baseline["cases"]}
+    print(f"\nCompared with {baseline_path} ({baseline.get('commit')}); ratio > 1 is slower")
+    for case in results["cases"]:
+        old = previous.get(key(case))
+        if old is None:
+            continue
+        ratios = {name: case["stages_seconds"][name] / old["stages_seconds"][name]
+                  for name in case["stages_seconds"] if old["stages_seconds"].get(name)}
+        stages = " ".join(f"{name}={ratio:.2f}" for name, ratio in ratios.items())
+        print(f"  scale={case['scale']} t={case['time_steps']} nan={case['nan_ratio']}: "
+              f"total={case['end_to_end_seconds'] / old['end_to_end_seconds']:.2f} "
+              f"rss={case['peak_rss_mb'] / old['peak_rss_mb']:.2f} {stages}")
+
+
+def parse_list(value, kind):
+    return [kind(v) for v in value.split(",") if v.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the NetCDF to COG conversion")
+    parser.add_argument("--scales", default="1,2", help="Grid refinement factors of the 0.05 deg grid")
+    parser.add_argument("--times", default="1,24", help="Time steps per file")
+    parser.add_argument("--nan-ratios", default="0,0.3", help="Fraction of NaN pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is reported")
+    parser.add_argument("--output", default="bench_convert.json", help="Result JSON file")
+    parser.add_argument("--compare", help="Earlier result JSON to compare against")
+    parser.add_argument("--work-dir", help="Directory for generated files (default: a temp dir)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cases = [
+        {"scale": scale, "time_steps": steps, "nan_ratio": ratio}
+        for scale in parse_list(args.scales, int)
+        for steps in parse_list(args.times, int)
+        for ratio in parse_list(args.nan_ratios, float)
+    ]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench-convert-")
+    context = multiprocessing.get_context("spawn")
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {name: os.environ[name] for name in sorted(os.environ)
+                     if name.startswith(("COG_", "STATS_", "HISTOGRAM_"))},
+        "cases": [],
+    }
+    try:
+        for case in cases:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case, work_dir, args.repeat))
+            results["cases"].append(result)
+            stages = " ".join(f"{k}={v:.3f}" for k, v in result["stages_seconds"].items())
+            print(f"scale={case['scale']} t={case['time_steps']} nan={case['nan_ratio']} "
+                  f"({result['width']}x{result['height']}): {result['end_to_end_seconds']:.2f}s, "
+                  f"{result['frames_per_second']:.1f} frames/s, peak RSS {result['peak_rss_mb']:.0f} MB | {stages}")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 let map;
 let dates = [];
 let scalingParams = {};
+let cogPaths = {};
 let currentIndex = 0;
 let animationId = null;
 let isPlaying = false;
@@ -92,8 +93,9 @@ function showNotification(message, type = 'info') {
 // Data loading
 function loadTimestamps() {
     showLoading();
+    const variable = document.getElementById("data-layer").value;
     
-    fetch('/api/timestamps')
+    fetch(`/api/timestamps?variable=${encodeURIComponent(variable)}`)
         .then(res => {
             if (!res.ok) {
                 throw new Error(`HTTP ${res.status}: ${res.statusText}`);
@@ -101,19 +103,26 @@ function loadTimestamps() {
             return res.json();
         })
         .then(data => {
+            // Timestamps of a previously selected variable no longer apply
+            dates = [];
+            scalingParams = {};
             if (data.length === 0) {
                 document.getElementById("range-info").textContent = "No data available.";
                 showNotification("No data available", "error");
                 return;
             }
             
-            // Store dates and scaling parameters
+            // Store dates and scaling parameters of the selected variable
             dates = data.map(item => item.datetime);
             data.forEach(item => {
                 scalingParams[item.datetime] = {
                     vmin: item.vmin,
                     vmax: item.vmax
                 };
+                // Content-hashed COG path; its tiles never change and are cached for a year
+                if (item.filepath) {
+                    cogPaths[`${variable}|${item.datetime}`] = item.filepath;
+                }
             });
 
             setupTimeControls();
@@ -171,12 +180,13 @@ function updateLayerByTime(index) {
     const scaling = scalingParams[date];
     const variable = document.getElementById("data-layer").value;
     const colormap = document.getElementById("colormap-select").value;
-    const tiffName = `${variable}_${date}.tif`;
-    const tiffPath = `/opt/cogs/${tiffName}`;
+    const tiffPath = cogPaths[`${variable}|${date}`] || `/opt/cogs/${variable}_${date}.tif`;
+    const tiffName = tiffPath.split('/').pop();
     
     console.log(`🎯 Loading: ${tiffName} with scaling:`, scaling);
     
-    fetch(`/cog/info?url=${encodeURIComponent(tiffPath)}`)
+    // info.geojson reports geographic bounds, also for COGs stored in EPSG:3857
+    fetch(`/cog/info.geojson?url=${encodeURIComponent(tiffPath)}`)
         .then(response => {
             if (!response.ok) {
                 throw new Error(`File not found: ${tiffName}`);
@@ -192,15 +202,17 @@ function updateLayerByTime(index) {
                 map.removeSource('dataLayer');
             }
 
-            // Construct tile URL with scaling
-            const tileUrl = `/cog/tiles/WebMercatorQuad/{z}/{x}/{y}.png?url=${encodeURIComponent(tiffPath)}&rescale=${scaling.vmin},${scaling.vmax}&colormap_name=${colormap}`;
+            // Construct tile URL with scaling (unscale applies scale/offset of quantized COGs).
+            // nginx serves pre-rendered tiles from /tiles and proxies the rest to TiTiler.
+            const cogStem = tiffName.replace(/\.tif$/, '');
+            const tileUrl = `/tiles/${cogStem}/${colormap}/{z}/{x}/{y}.png?unscale=true&rescale=${scaling.vmin},${scaling.vmax}`;
 
             // Add new source
             map.addSource('dataLayer', {
                 type: 'raster',
                 tiles: [tileUrl],
                 tileSize: 256,
-                bounds: info.bounds
+                bounds: info.bbox
             });
 
             // Add new layer
@@ -354,6 +366,11 @@ function setupEventListeners() {
         document.getElementById("data-opacity-value").textContent = `${e.target.value}%`;
     });
     
+    document.getElementById("data-layer").addEventListener("change", () => {
+        pauseAnimation();
+        loadTimestamps();
+    });
+    
     document.getElementById("colormap-select").addEventListener("change", () => {
         updateLayerByTime(currentIndex);
     });
@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app and HeMu modules are flat scripts run from their own directories
+sys.path[:0] = [os.path.join(ROOT, "app"), os.path.join(ROOT, "HeMu")]
+
+# Settings the modules read at import time
+os.environ.setdefault("DATETIME_FORMAT", "%Y%m%dT%H%M%S")
+os.environ.setdefault("VARIABLE", "SISGHI-No-Horizon")
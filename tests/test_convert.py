@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import rasterio
+import xarray as xr
+import rioxarray  # noqa: F401  (registers the .rio accessor)
+from rasterio.transform import from_origin
+
+from convert import (check_cog_compliance, quantize_data_array, quantized_cog_options,
+                     resolve_cog_options, validate_cog, write_cog)
+
+
+def make_frame(size, resolution=0.01):
+    """A `size` x `size` float32 frame on a lat/lon grid over Switzerland."""
+    values = np.linspace(0, 1000, size * size, dtype=np.float32).reshape(size, size)
+    x = 6.0 + resolution * (np.arange(size) + 0.5)
+    y = 47.5 - resolution * (np.arange(size) + 0.5)
+    frame = xr.DataArray(values, dims=("y", "x"), coords={"y": y, "x": x})
+    return frame.rio.write_crs("EPSG:4326")
+
+
+def test_single_tile_default_cog_is_valid(tmp_path):
+    # Block width equals image width: rasterio reports tiled=False for this layout
+    path = tmp_path / "frame.tif"
+    write_cog(make_frame(512), path, resolve_cog_options("default"), validate=True)
+    with rasterio.open(path) as src:
+        assert src.block_shapes[0] == (512, 512)
+    assert check_cog_compliance(path) == []
+
+
+def test_webmercator_lerc_int16_cog_is_valid(tmp_path):
+    # Small enough to land in a single 256 px WebMercatorQuad tile
+    quantization = {"dtype": "int16", "nodata": -32768, "scale_factor": 0.1, "add_offset": 0.0}
+    options = quantized_cog_options(resolve_cog_options("webmercator", compress="LERC_ZSTD"), quantization)
+    path = tmp_path / "frame.tif"
+    write_cog(quantize_data_array(make_frame(32), quantization), path, options, validate=True)
+    with rasterio.open(path) as src:
+        assert src.crs.to_epsg() == 3857
+        assert (src.width, src.height) == (256, 256)
+        assert src.block_shapes[0] == (256, 256)
+    assert check_cog_compliance(path) == []
+
+
+def test_strip_layout_tiff_is_rejected(tmp_path):
+    path = tmp_path / "strips.tif"
+    with rasterio.open(path, "w", driver="GTiff", width=512, height=512, count=1, dtype="float32",
+                       crs="EPSG:4326", transform=from_origin(6.0, 47.5, 0.01, 0.01)) as dst:
+        dst.write(np.ones((1, 512, 512), dtype=np.float32))
+
+    problems = check_cog_compliance(path)
+    assert any(problem.startswith("not internally tiled") for problem in problems)
+    with pytest.raises(ValueError, match="not a valid COG"):
+        validate_cog(path)
+
+
+def test_tiled_geotiff_without_cog_layout_is_rejected(tmp_path):
+    # Internally tiled, but a plain GeoTIFF: no ghost header and no overviews
+    path = tmp_path / "tiled.tif"
+    with rasterio.open(path, "w", driver="GTiff", width=1024, height=1024, count=1, dtype="float32",
+                       crs="EPSG:4326", transform=from_origin(6.0, 47.5, 0.01, 0.01),
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(np.ones((1, 1024, 1024), dtype=np.float32))
+
+    problems = check_cog_compliance(path)
+    assert "missing LAYOUT=COG ghost header" in problems
+    assert "no overviews" in problems
+    assert not any(problem.startswith("not internally tiled") for problem in problems)
+    with pytest.raises(ValueError, match="not a valid COG"):
+        validate_cog(path)
+
+
+def test_multi_tile_cog_with_overviews_is_valid(tmp_path):
+    path = tmp_path / "frame.tif"
+    write_cog(make_frame(1500), path, resolve_cog_options("default"), validate=True)
+    with rasterio.open(path) as src:
+        assert src.overviews(1)
+    assert check_cog_compliance(path) == []
+
+
+@pytest.mark.parametrize("profile", ["default", "webmercator"])
+def test_write_cog_returns_written_grid(tmp_path, profile):
+    frame = make_frame(256)
+    path = tmp_path / "frame.tif"
+    grid = write_cog(frame, path, resolve_cog_options(profile))
+    with rasterio.open(path) as src:
+        assert grid["crs"] == src.crs.to_string()
+        assert grid["resolution"] == pytest.approx(max(src.res))
+    # The data extent, not the tile-aligned padded extent of the webmercator file
+    assert grid["bounds"] == pytest.approx([6.0, 44.94, 8.56, 47.5])
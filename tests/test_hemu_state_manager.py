@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import pytest
+
+from hemu_state_manager import TEMPORAL_VARS, HeMuStateManager, merge_intervals, subtract_intervals
+
+
+@pytest.fixture
+def state(tmp_path):
+    return HeMuStateManager("CH", state_file=tmp_path / "state_CH.json", db_path=tmp_path / "state_CH.db")
+
+
+def at(hour, minute=0):
+    return datetime(2024, 6, 1, hour, minute)
+
+
+def test_subtract_and_merge_intervals():
+    assert subtract_intervals(0, 10, []) == [(0, 10)]
+    assert subtract_intervals(0, 10, [(2, 4), (6, 8)]) == [(0, 2), (4, 6), (8, 10)]
+    assert subtract_intervals(2, 8, [(0, 3), (7, 12)]) == [(3, 7)]
+    assert subtract_intervals(2, 8, [(0, 12)]) == []
+    assert merge_intervals([(5, 6), (0, 2), (2, 3), (1, 4)]) == [(0, 4), (5, 6)]
+
+
+def test_missing_ranges_are_the_uncovered_slots(state):
+    assert state.get_missing_date_ranges(at(9), at(13)) == [(at(9), at(13))]
+    assert state.get_high_water_mark() is None
+
+    state.mark_date_range_processed(at(10), at(12), TEMPORAL_VARS)
+    assert state.get_missing_date_ranges(at(9), at(13)) == [(at(9), at(10)), (at(12), at(13))]
+    assert state.get_missing_date_ranges(at(10, 15), at(11, 45)) == []
+    assert state.is_date_range_processed(at(10), at(12))
+    assert state.get_high_water_mark() == at(12)
+
+
+def test_single_slot_gap_between_runs(state):
+    state.mark_date_range_processed(at(10), at(10, 45), TEMPORAL_VARS)
+    state.mark_date_range_processed(at(11), at(12), TEMPORAL_VARS)
+    assert state.get_missing_date_ranges(at(10), at(12)) == [(at(10, 45), at(11))]
+
+    # Filling the gap merges the coverage into one interval
+    state.mark_date_range_processed(at(10, 45), at(11), TEMPORAL_VARS)
+    assert state.get_missing_date_ranges(at(10), at(12)) == []
+    with state._connect() as conn:
+        assert state._covered_slots(conn, "HRV", 0, 2 ** 40) == state._covered_slots(conn, "SZA", 0, 2 ** 40)
+        assert len(state._covered_slots(conn, "HRV", 0, 2 ** 40)) == 1
+
+
+def test_partial_slots_and_variables_are_not_covered(state):
+    # Only slots entirely inside the run count
+    state.mark_date_range_processed(at(10, 7), at(10, 52), TEMPORAL_VARS)
+    assert state.get_missing_date_ranges(at(10), at(11)) == [(at(10), at(10, 15)), (at(10, 45), at(11))]
+
+    # A slot is missing while any required variable lacks it
+    state.mark_date_range_processed(at(11), at(12), ["HRV", "SZA"])
+    assert state.get_missing_date_ranges(at(11), at(12)) == [(at(11), at(12))]
+    assert state.get_missing_date_ranges(at(11), at(12), required_vars=["HRV", "SZA"]) == []
+    assert state.get_high_water_mark() == at(10, 45)
+
+
+def test_long_gaps_are_split_into_chunks(state):
+    start, end = datetime(2024, 6, 1), datetime(2024, 6, 4)
+    assert state.get_missing_date_ranges(start, end, chunk_days=1) == [
+        (datetime(2024, 6, 1), datetime(2024, 6, 2)),
+        (datetime(2024, 6, 2), datetime(2024, 6, 3)),
+        (datetime(2024, 6, 3), datetime(2024, 6, 4)),
+    ]
@@ -0,0 +1,92 @@
+import os
+
+from jobqueue import JobQueue
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.db"), **kwargs)
+
+
+def make_files(tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        paths.append(str(path))
+    return paths
+
+
+def test_enqueue_is_idempotent_and_claim_leases_each_job_once(tmp_path):
+    queue = make_queue(tmp_path)
+    paths = make_files(tmp_path, "a.nc", "b.nc")
+    assert queue.enqueue("SIS", paths) == 2
+    assert queue.enqueue("SIS", paths) == 0
+
+    first = queue.claim("SIS", "worker-1", limit=1)
+    second = queue.claim("SIS", "worker-2", limit=5)
+    assert [job["path"] for job in first + second] == paths
+    assert [job["attempts"] for job in first + second] == [1, 1]
+    assert queue.claim("SIS", "worker-3", limit=5) == []
+    assert queue.claim("other", "worker-3") == []
+
+
+def test_complete_and_extend_require_the_lease(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue("SIS", make_files(tmp_path, "a.nc"))
+    job = queue.claim("SIS", "worker-1")[0]
+
+    assert queue.extend([job["id"]], "worker-2") == 0
+    assert queue.extend([job["id"]], "worker-1") == 1
+    assert not queue.complete(job["id"], "worker-2")
+    assert queue.complete(job["id"], "worker-1")
+    assert queue.extend([job["id"]], "worker-1") == 0
+    assert queue.status()["counts"] == {"SIS": {"done": 1}}
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=-1)
+    queue.enqueue("SIS", make_files(tmp_path, "a.nc"))
+    job = queue.claim("SIS", "worker-1")[0]
+
+    reclaimed = queue.claim("SIS", "worker-2")
+    assert [j["id"] for j in reclaimed] == [job["id"]]
+    assert reclaimed[0]["attempts"] == 2
+    # The first worker lost the job and cannot finish it
+    assert not queue.complete(job["id"], "worker-1")
+
+
+def test_failed_job_backs_off_then_moves_to_dead_letters(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2, retry_seconds=3600)
+    queue.enqueue("SIS", make_files(tmp_path, "a.nc"))
+    job = queue.claim("SIS", "worker-1")[0]
+    assert queue.fail(job["id"], "worker-1", "boom") == "queued"
+    # Not due before its retry delay
+    assert queue.claim("SIS", "worker-1") == []
+
+    with queue._transaction() as conn:
+        conn.execute("UPDATE jobs SET available_at = 0")
+    job = queue.claim("SIS", "worker-1")[0]
+    assert queue.fail(job["id"], "worker-1", "boom again") == "dead"
+    assert queue.claim("SIS", "worker-1") == []
+    dead = queue.status()["dead"]
+    assert [(d["id"], d["attempts"], d["last_error"]) for d in dead] == [(job["id"], 2, "boom again")]
+
+    assert queue.retry_dead("SIS") == 1
+    job = queue.claim("SIS", "worker-1")[0]
+    assert job["attempts"] == 1
+
+
+def test_prune_keeps_done_jobs_of_unchanged_files(tmp_path):
+    queue = make_queue(tmp_path)
+    unchanged, rewritten, removed = make_files(tmp_path, "a.nc", "b.nc", "c.nc")
+    queue.enqueue("SIS", [unchanged, rewritten, removed])
+    for job in queue.claim("SIS", "worker-1", limit=3):
+        queue.complete(job["id"], "worker-1")
+
+    with open(rewritten, "ab") as f:
+        f.write(b"more")
+    os.remove(removed)
+    assert queue.prune(older_than_seconds=-1) == 2
+    # The kept row still makes re-enqueueing the unchanged file a no-op
+    assert queue.enqueue("SIS", [unchanged]) == 0
+    assert queue.enqueue("SIS", [rewritten]) == 1
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+zarr = pytest.importorskip("zarr")
+import timeseries  # noqa: E402
+
+
+def write_cog(path, value):
+    with rasterio.open(path, "w", driver="GTiff", width=20, height=10, count=1, dtype="float32",
+                       crs="EPSG:4326", transform=from_origin(6.0, 47.0, 0.1, 0.1)) as dst:
+        dst.write(np.full((1, 10, 20), value, dtype=np.float32))
+    return str(path)
+
+
+def test_reprocessed_frame_replaces_stored_values(tmp_path):
+    store = str(tmp_path / "store.zarr")
+    first = datetime(2024, 1, 1, 10)
+    timeseries.append_frames("V", [(first, write_cog(tmp_path / "a.tif", 1.0)),
+                                   (first + timedelta(minutes=15), write_cog(tmp_path / "b.tif", 2.0))], store=store)
+    assert timeseries.append_frames("V", [(first, write_cog(tmp_path / "a2.tif", 5.0))], store=store) == 1
+
+    series = timeseries.query_point("V", 6.55, 46.55, store=store)
+    assert series["values"].tolist() == [5.0, 2.0]
+    group = zarr.open_group(f"{store}/V", mode="r")
+    assert group["time"].shape[0] == group["values"].shape[0] == 2
+
+
+def test_queries_read_only_the_selected_rows(tmp_path, monkeypatch):
+    store = str(tmp_path / "store.zarr")
+    first = datetime(2024, 1, 1)
+    frames = [(first + timedelta(minutes=15 * i), write_cog(tmp_path / f"{i}.tif", float(i))) for i in range(8)]
+    # Out of order on purpose: results are still sorted by time
+    timeseries.append_frames("V", frames[4:], store=store)
+    timeseries.append_frames("V", frames[:4], store=store)
+
+    selected = timeseries._time_selection
+    spans = []
+
+    def recording_selection(times, start, end):
+        rows, order = selected(times, start, end)
+        spans.append(rows.stop - rows.start)
+        return rows, order
+
+    monkeypatch.setattr(timeseries, "_time_selection", recording_selection)
+    start, end = frames[5][0], frames[6][0]
+    point = timeseries.query_point("V", 6.55, 46.55, start=start, end=end, store=store)
+    area = timeseries.query_area("V", bbox=(6.0, 46.5, 6.5, 47.0), start=start, end=end, store=store)
+
+    assert point["values"].tolist() == [5.0, 6.0]
+    assert area["values"].tolist() == [5.0, 6.0]
+    assert spans == [2, 2]